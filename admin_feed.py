@@ -0,0 +1,138 @@
+import html
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, Any, List
+
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages over 4096 characters; leave room for the header
+MAX_DIGEST_CHARS = 3800
+# Channels are limited to roughly 20 messages per minute
+MIN_SEND_INTERVAL = 3.0
+
+
+class AdminFeed:
+    """
+    Background pipeline that posts user activity to the admin channel as digests.
+
+    Handlers call `publish()`, which never waits: events go into a bounded
+    queue and are dropped (and counted) when it is full. A worker task
+    collects events for up to `flush_interval` seconds or `max_batch` events,
+    then sends them as one message, honouring Telegram's RetryAfter.
+    """
+
+    def __init__(self, chat_id: int, max_queue: int = 1000, flush_interval: float = 10.0,
+                 max_batch: int = 25):
+        self.chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.logger = logging.getLogger('AdminFeed')
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._bot = None
+        self._task = None
+        self._last_sent = 0.0
+
+        self.published = 0
+        self.dropped = 0
+        self._dropped_since_digest = 0
+        self.digests_sent = 0
+        self.send_failures = 0
+
+    def publish(self, user_id: int, username: str, action: str) -> bool:
+        """Queue one activity event. Returns False if it was dropped because the feed is backed up."""
+        try:
+            self._queue.put_nowait((user_id, username, action))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._dropped_since_digest += 1
+            return False
+        self.published += 1
+        return True
+
+    async def start(self, bot) -> None:
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            try:
+                await self._send(self._format_digest(batch))
+            except Exception as e:
+                self.send_failures += 1
+                self.logger.warning(f"Admin log failed: {e}")
+
+    async def _collect(self) -> List[tuple]:
+        """Wait for the first event, then gather more until the interval or batch size is reached."""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _format_digest(self, batch: List[tuple]) -> str:
+        users = {user_id for user_id, _, _ in batch}
+        lines = [f"📊 <b>Activity</b> — {len(batch)} event(s) from {len(users)} user(s)"]
+        length = len(lines[0])
+        for index, (user_id, username, action) in enumerate(batch):
+            line = (f"👤 <a href='tg://user?id={user_id}'>{html.escape(username)}</a> "
+                    f"(<code>{user_id}</code>): {html.escape(action[:200])}")
+            if length + len(line) > MAX_DIGEST_CHARS:
+                lines.append(f"… and {len(batch) - index} more")
+                break
+            lines.append(line)
+            length += len(line) + 1
+        if self._dropped_since_digest:
+            lines.append(f"⚠️ {self._dropped_since_digest} event(s) dropped (feed overloaded)")
+            self._dropped_since_digest = 0
+        return "\n".join(lines)
+
+    async def _send(self, text: str, attempts: int = 3) -> None:
+        # Even when batches fill up early, keep to the channel's flood limit
+        wait = self._last_sent + MIN_SEND_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_sent = time.monotonic()
+        for attempt in range(attempts):
+            try:
+                await self._bot.send_message(chat_id=self.chat_id, text=text, parse_mode=ParseMode.HTML)
+                self.digests_sent += 1
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self.logger.info(f"Admin feed flood-limited, retrying in {delay}s")
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self._queue.qsize(),
+            'published': self.published,
+            'dropped': self.dropped,
+            'digests_sent': self.digests_sent,
+            'send_failures': self.send_failures,
+        }
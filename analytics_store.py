@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsStore:
+    """
+    Usage analytics backed by SQLite (WAL).
+
+    `record()` only appends to an in-memory buffer, so handlers never touch the
+    disk. A background task flushes the buffer in one transaction every
+    `flush_interval` seconds or once `flush_batch` events are waiting, on a
+    worker thread so the event loop is never blocked.
+    """
+
+    def __init__(self, db_path: str = 'analytics.db', flush_interval: float = 5.0,
+                 flush_batch: int = 500, max_logs: int = 1000, legacy_json: Optional[str] = None,
+                 max_buffer: int = 50000):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_logs = max_logs
+        # Events kept while flushes keep failing; the oldest are dropped beyond this
+        self.max_buffer = max_buffer
+        self.legacy_json = legacy_json
+        self.logger = logging.getLogger('AnalyticsStore')
+
+        self._buffer: List[tuple] = []
+        self._buffer_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self._wakeup = None
+        self._task = None
+
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+        self.dropped_events = 0
+
+    # --- Write path ---
+
+    def record(self, user_id: int, username: str, text: str, when: Optional[datetime] = None) -> None:
+        """Buffer one user action. Cheap enough to call from any handler."""
+        when = when or datetime.now()
+        with self._buffer_lock:
+            self._buffer.append((user_id, username, text, when.strftime("%Y-%m-%d %H:%M:%S")))
+            pending = len(self._buffer)
+        if pending >= self.flush_batch and self._wakeup:
+            self._wakeup.set()
+
+    def _drain(self):
+        """Take the buffered events and their per-day counts."""
+        with self._buffer_lock:
+            events, self._buffer = self._buffer, []
+        daily: Dict[str, int] = {}
+        for event in events:
+            day = event[3][:10]
+            daily[day] = daily.get(day, 0) + 1
+        return events, daily
+
+    def _requeue(self, events: List[tuple]) -> None:
+        """Put the events of a failed flush back in front of those recorded since."""
+        with self._buffer_lock:
+            self._buffer = events + self._buffer
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped_events += overflow
+        self.failed_flushes += 1
+        if overflow > 0:
+            self.logger.warning(f"Analytics buffer full; dropped {overflow} oldest events")
+
+    def flush(self) -> int:
+        """Write buffered events to SQLite in a single transaction. Returns the number written."""
+        events, daily = self._drain()
+        if not events:
+            return 0
+        try:
+            self._write(events, daily)
+        except Exception:
+            # Keep the batch for the next flush (e.g. the database was locked by another worker)
+            self._requeue(events)
+            raise
+        self.flushes += 1
+        self.flushed_events += len(events)
+        return len(events)
+
+    def _write(self, events: List[tuple], daily: Dict[str, int]) -> None:
+        with self._db_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, ?)',
+                    [(event[0], event[3]) for event in events]
+                )
+                conn.executemany(
+                    'INSERT INTO daily_usage (day, requests) VALUES (?, ?) '
+                    'ON CONFLICT(day) DO UPDATE SET requests = requests + excluded.requests',
+                    list(daily.items())
+                )
+                conn.execute(
+                    "UPDATE counters SET value = value + ? WHERE name = 'total_requests'", (len(events),)
+                )
+                conn.executemany(
+                    'INSERT INTO events (user_id, username, text, time) VALUES (?, ?, ?, ?)', events
+                )
+                conn.execute(
+                    'DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?', (self.max_logs,)
+                )
+
+    # --- Background flusher ---
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._open)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+        with self._db_lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                self.logger.error(f"Failed to flush analytics: {e}")
+
+    # --- Query API ---
+
+    def total_users(self) -> int:
+        return self._query_one('SELECT COUNT(*) FROM users')
+
+    def total_requests(self) -> int:
+        return self._query_one("SELECT value FROM counters WHERE name = 'total_requests'")
+
+    def daily_usage(self, days: Optional[int] = None) -> Dict[str, int]:
+        """Requests per day, oldest first; limited to the last `days` days if given."""
+        self.flush()
+        sql = 'SELECT day, requests FROM daily_usage ORDER BY day DESC'
+        params: tuple = ()
+        if days:
+            sql += ' LIMIT ?'
+            params = (days,)
+        with self._db_lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return dict(reversed(rows))
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        self.flush()
+        with self._db_lock:
+            rows = self._connect().execute(
+                'SELECT user_id, username, text, time FROM events ORDER BY id DESC LIMIT ?', (limit,)
+            ).fetchall()
+        return [{"user": r[0], "username": r[1], "text": r[2], "time": r[3]} for r in reversed(rows)]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "total_users": self.total_users(),
+            "total_requests": self.total_requests(),
+            "pending_events": len(self._buffer),
+            "flushes": self.flushes,
+        }
+
+    def _query_one(self, sql: str) -> int:
+        self.flush()
+        with self._db_lock:
+            row = self._connect().execute(sql).fetchone()
+        return row[0] if row else 0
+
+    # --- Storage ---
+
+    def _open(self) -> None:
+        with self._db_lock:
+            self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database and create the schema. Caller must hold `_db_lock`."""
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS daily_usage (day TEXT PRIMARY KEY, requests INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, username TEXT, text TEXT, time TEXT)'
+            )
+            created = conn.execute(
+                "INSERT OR IGNORE INTO counters (name, value) VALUES ('total_requests', 0)"
+            ).rowcount
+        self._conn = conn
+        if created:
+            self._import_legacy_json()
+        return conn
+
+    def _import_legacy_json(self) -> None:
+        """One-time import of the old analytics.json into a freshly created database."""
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return
+        try:
+            with open(self.legacy_json, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Could not import {self.legacy_json}: {e}")
+            return
+
+        started = time.monotonic()
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, NULL)',
+                [(user_id,) for user_id in data.get("total_users", [])]
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO daily_usage (day, requests) VALUES (?, ?)',
+                list(data.get("daily_usage", {}).items())
+            )
+            self._conn.execute(
+                "UPDATE counters SET value = ? WHERE name = 'total_requests'", (data.get("total_requests", 0),)
+            )
+            self._conn.executemany(
+                'INSERT INTO events (user_id, username, text, time) VALUES (?, ?, ?, ?)',
+                [(log.get("user"), log.get("username"), log.get("text"), log.get("time")) for log in data.get("logs", [])]
+            )
+        self.logger.info(f"Imported {self.legacy_json} in {time.monotonic() - started:.2f}s")
+
+
+class RedisAnalyticsStore(AnalyticsStore):
+    """
+    AnalyticsStore that flushes into a Redis-protocol server shared by all replicas.
+
+    Users are kept in a set, daily counts in a hash and recent events in a
+    capped list; each flush is a single pipelined round trip.
+    """
+
+    PREFIX = 'analytics:'
+
+    def __init__(self, backend, flush_interval: float = 5.0, flush_batch: int = 500, max_logs: int = 1000):
+        super().__init__(db_path='', flush_interval=flush_interval, flush_batch=flush_batch, max_logs=max_logs)
+        self.backend = backend
+
+    def _open(self) -> None:
+        self.backend.execute('PING')
+
+    def _write(self, events: List[tuple], daily: Dict[str, int]) -> None:
+        p = self.PREFIX
+        commands = [('SADD', p + 'users', *{event[0] for event in events}),
+                    ('INCRBY', p + 'total_requests', len(events))]
+        commands += [('HINCRBY', p + 'daily_usage', day, count) for day, count in daily.items()]
+        commands.append(('LPUSH', p + 'events', *(json.dumps(event) for event in events)))
+        commands.append(('LTRIM', p + 'events', 0, self.max_logs - 1))
+        self.backend.pipeline(commands)
+
+    def total_users(self) -> int:
+        self.flush()
+        return self.backend.execute('SCARD', self.PREFIX + 'users')
+
+    def total_requests(self) -> int:
+        self.flush()
+        return int(self.backend.execute('GET', self.PREFIX + 'total_requests') or 0)
+
+    def daily_usage(self, days: Optional[int] = None) -> Dict[str, int]:
+        self.flush()
+        flat = self.backend.execute('HGETALL', self.PREFIX + 'daily_usage') or []
+        usage = sorted((flat[i], int(flat[i + 1])) for i in range(0, len(flat), 2))
+        return dict(usage[-days:] if days else usage)
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        self.flush()
+        rows = [json.loads(row) for row in self.backend.execute('LRANGE', self.PREFIX + 'events', 0, limit - 1)]
+        return [{"user": r[0], "username": r[1], "text": r[2], "time": r[3]} for r in reversed(rows)]
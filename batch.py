@@ -0,0 +1,83 @@
+import re
+import html
+from typing import List, Optional, Iterable, Union, IO
+
+from telegram import InputFile, InputMediaAudio, InputMediaVideo
+
+from file_cache import canonicalize_url
+
+# Telegram accepts 2-10 items per media group
+MEDIA_GROUP_SIZE = 10
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+')
+TRAILING_PUNCTUATION = '.,;:!?)]}\'"'
+
+# Failures listed in the final batch status before the rest are summarized
+MAX_LISTED_FAILURES = 5
+
+
+def extract_urls(text: str, linked: Iterable[str] = (), limit: Optional[int] = None) -> List[str]:
+    """
+    Links in a message, in order of appearance and without duplicates.
+
+    `linked` are URLs behind text links (entities), which don't appear in the
+    text itself. At most `limit` links are returned.
+    """
+    found = [match.rstrip(TRAILING_PUNCTUATION) for match in URL_PATTERN.findall(text or '')]
+    urls, seen = [], set()
+    for url in [*found, *linked]:
+        key = canonicalize_url(url)
+        if url and key not in seen:
+            seen.add(key)
+            urls.append(url)
+    return urls[:limit] if limit else urls
+
+
+def media_group(download_format: str, contents: List[Union[str, IO[bytes]]],
+                caption: Optional[str] = None) -> List[Union[InputMediaAudio, InputMediaVideo]]:
+    """
+    Media group items for cached file_ids and open files (captioned on the first item).
+
+    Uploaded files must be attached: each then goes in its own multipart field,
+    referenced from the item as attach://<name>. Otherwise every file is sent
+    under one field and Telegram rejects the group.
+    """
+    media_type = InputMediaAudio if download_format == "audio" else InputMediaVideo
+    items = []
+    for index, content in enumerate(contents):
+        if not isinstance(content, str):
+            content = InputFile(content, read_file_handle=False, attach=True)
+        items.append(media_type(content, caption=caption if index == 0 else None))
+    return items
+
+
+class BatchProgress:
+    """Counts for one batch of links and the status text edited into its progress message."""
+
+    def __init__(self, total: int, title: Optional[str] = None):
+        self.total = total
+        self.title = title
+        self.sent = 0
+        self.failures = []
+
+    @property
+    def finished(self) -> int:
+        return self.sent + len(self.failures)
+
+    def fail(self, url: str, error) -> None:
+        self.failures.append((url, str(error)))
+
+    def render(self) -> str:
+        title = html.escape(self.title) if self.title else f"{self.total} links"
+        if self.finished < self.total:
+            lines = [f"📦 <b>{title}</b>", f"⏳ {self.finished}/{self.total} done"]
+            if self.failures:
+                lines[-1] += f" ({len(self.failures)} failed)"
+            return "\n".join(lines)
+
+        lines = [f"📦 <b>{title}</b>", f"✅ Sent {self.sent} of {self.total}"]
+        for url, error in self.failures[:MAX_LISTED_FAILURES]:
+            lines.append(f"❌ {html.escape(url)}: {html.escape(error)}")
+        if len(self.failures) > MAX_LISTED_FAILURES:
+            lines.append(f"… and {len(self.failures) - MAX_LISTED_FAILURES} more failed")
+        return "\n".join(lines)
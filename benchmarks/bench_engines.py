@@ -0,0 +1,86 @@
+"""
+Compare per-request overhead of the subprocess and in-process yt-dlp engines.
+
+Serves a small file from a local HTTP server so the numbers reflect engine
+start-up and extractor cost rather than network speed:
+
+    python benchmarks/bench_engines.py --requests 20 --size-kb 256
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download_engines import SubprocessEngine, InProcessEngine  # noqa: E402
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory: str):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_engine(engine, url: str, requests: int):
+    timings = []
+    for _ in range(requests):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            started = time.perf_counter()
+            path = engine.download_video(url, temp_dir)
+            timings.append(time.perf_counter() - started)
+            if not path:
+                raise RuntimeError("engine returned no file")
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return timings
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<12} n={len(timings):<4} mean={statistics.mean(timings) * 1000:8.1f}ms "
+          f"p50={statistics.median(timings) * 1000:8.1f}ms p95={p95 * 1000:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    media_dir = tempfile.mkdtemp()
+    with open(os.path.join(media_dir, 'clip.mp4'), 'wb') as f:
+        f.write(os.urandom(args.size_kb * 1024))
+    server = serve_directory(media_dir)
+    url = f"http://127.0.0.1:{server.server_address[1]}/clip.mp4"
+
+    try:
+        report('subprocess', run_engine(SubprocessEngine(), url, args.requests))
+
+        engine = InProcessEngine(workers=args.workers)
+        try:
+            run_engine(engine, url, 1)  # wait for the pool to finish warming
+            report('inprocess', run_engine(engine, url, args.requests))
+        finally:
+            engine.shutdown()
+    finally:
+        server.shutdown()
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,563 @@
+"""
+Load-test the whole bot offline: webhook -> handlers -> yt-dlp -> upload.
+
+Starts the bot (main.py) as a subprocess pointed at a stub Bot API server
+run by this script, and serves media from a local HTTP server that yt-dlp's
+generic extractor downloads from, so no network is needed. Virtual users
+send a link, wait for the format prompt, tap a button and wait for the
+upload; the script reports end-to-end latency percentiles, updates/sec and
+the bot's CPU and memory use:
+
+    python benchmarks/bench_load.py --users 20 --requests 200 --distinct-urls 50 --size-kb 2048
+
+`--scenario start` sends /start instead, to measure the update path alone;
+`--scenario batch` sends `--batch-size` links per message and times delivery
+of the whole batch.
+Settings of the bot can be overridden with `--env NAME=VALUE` (repeatable),
+e.g. `--env DOWNLOAD_ENGINE=subprocess --env MAX_CONCURRENT_DOWNLOADS=4`.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = '123456:BENCHMARK'
+FAILURE_PREFIXES = ('❌', '🚫')
+BATCH_DONE = '✅ Sent'
+
+
+# --- Local media server ---
+
+class MediaHandler(SimpleHTTPRequestHandler):
+    """Serves the same clip under any /<name>.mp4 path, so every URL is a distinct link."""
+
+    clip_path = None
+
+    def translate_path(self, path):
+        return self.clip_path
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_clip(path: str, size_kb: int) -> None:
+    if shutil.which('ffmpeg'):
+        # A real clip, so ffprobe and the remux path see valid media
+        seconds = max(1, size_kb // 64)
+        subprocess.run([
+            'ffmpeg', '-nostdin', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f'testsrc2=size=320x180:rate=15:duration={seconds}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+            '-c:v', 'libx264', '-b:v', '400k', '-c:a', 'aac', '-shortest', path
+        ], check=True)
+    else:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+
+
+# --- Stub Bot API ---
+
+class BadRequest(Exception):
+    """A request the real Bot API would reject with 400 Bad Request."""
+
+
+class StubBotAPI:
+    """
+    Answers the Bot API methods the bot uses and reports what it sent.
+
+    Every message the bot sends to a chat becomes an event on `on_event`
+    (called from the server's threads): 'prompt' for messages with buttons,
+    'media' for uploads, 'error' for failure notices, 'batch_done' for a
+    finished batch's status and 'message' otherwise.
+    """
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                params = stub.parse(self.headers.get('Content-Type', ''), body)
+                try:
+                    result = stub.handle(method, params, len(body))
+                    status, reply = 200, {'ok': True, 'result': result}
+                except BadRequest as e:
+                    status, reply = 400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+                payload = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @staticmethod
+    def parse(content_type: str, body: bytes):
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=email_policy).parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+            )
+            # File parts are only listed by name, for attach:// references
+            params = {'_files': set()}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is None:
+                    params[name] = part.get_content()
+                else:
+                    params['_files'].add(name)
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def message(self, chat_id: int, **fields):
+        return dict(
+            message_id=next(self._message_ids), date=int(time.time()),
+            chat={'id': chat_id, 'type': 'private'}, **fields
+        )
+
+    def handle(self, method: str, params, body_size: int):
+        now = time.perf_counter()
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        text = params.get('text') or ''
+
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            message = self.message(chat_id, text=text)
+            if method == 'editMessageText':
+                message['message_id'] = int(params['message_id'])
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if text.startswith(FAILURE_PREFIXES):
+                self.on_event(chat_id, 'error', text, now)
+            elif BATCH_DONE in text:
+                self.on_event(chat_id, 'batch_done', text, now)
+            elif method == 'sendMessage':
+                buttons = [button.get('callback_data') for row in (markup or {}).get('inline_keyboard', [])
+                           for button in row if button.get('callback_data')]
+                self.on_event(chat_id, 'prompt' if buttons else 'message', {'message': message, 'buttons': buttons}, now)
+            return message
+        if method in ('sendVideo', 'sendAudio'):
+            field = 'video' if method == 'sendVideo' else 'audio'
+            with self._lock:
+                self.uploaded_bytes += body_size
+            file_id = params.get(field) or f'{field}-{next(self._file_ids)}'
+            media = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 0}
+            if field == 'video':
+                media.update(width=320, height=180)
+            self.on_event(chat_id, 'media', body_size, now)
+            return self.message(chat_id, **{field: media})
+        if method == 'sendMediaGroup':
+            with self._lock:
+                self.uploaded_bytes += body_size
+            messages = []
+            for item in json.loads(params['media']):
+                field = item['type']
+                # Like Telegram: every item names a file_id or an uploaded part (attach://<part>)
+                reference = item.get('media')
+                if not reference:
+                    raise BadRequest("media group item has no media")
+                if reference.startswith('attach://'):
+                    if reference[len('attach://'):] not in params.get('_files', ()):
+                        raise BadRequest(f"file {reference} not found in the request")
+                    file_id = f'{field}-{next(self._file_ids)}'
+                else:
+                    file_id = reference
+                messages.append(self.message(chat_id, **{field: {
+                    'file_id': file_id, 'file_unique_id': file_id, 'duration': 0, 'width': 320, 'height': 180
+                }}))
+            self.on_event(chat_id, 'media', body_size, now)
+            return messages
+        if method == 'answerCallbackQuery':
+            if str(params.get('show_alert')).lower() == 'true':
+                self.on_event(None, 'error', params.get('text'), now)
+            return True
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'U'}}
+        # deleteMessage, setWebhook, sendChatAction, ...
+        return True
+
+    def close(self):
+        self.server.shutdown()
+
+
+# --- Resource sampling ---
+
+def process_tree(pid: int):
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def sample_usage(pid: int):
+    """CPU seconds (including reaped children) and RSS bytes of the process tree."""
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu, rss = 0.0, 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime, stime, cutime, cstime and rss, counted from the state field
+        cpu += sum(int(value) for value in fields[11:15]) / ticks
+        rss += int(fields[21]) * page
+    return cpu, rss
+
+
+class UsageSampler:
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            _, rss = sample_usage(self.pid)
+            self.peak_rss = max(self.peak_rss, rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.cpu_start, _ = sample_usage(self.pid)
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> float:
+        self._task.cancel()
+        cpu_end, _ = sample_usage(self.pid)
+        return cpu_end - self.cpu_start
+
+
+# --- Load generation ---
+
+class LoadTest:
+    def __init__(self, args, stub_events):
+        self.args = args
+        self.events = stub_events
+        self.update_ids = itertools.count(1)
+        self.updates_sent = 0
+        self.ack_latency = []
+        self.prompt_latency = []
+        self.media_latency = []
+        self.total_latency = []
+        self.outcomes = {}
+
+    def update(self, **fields):
+        self.updates_sent += 1
+        return dict(update_id=next(self.update_ids), **fields)
+
+    def text_update(self, user_id: int, text: str):
+        return self.update(message={
+            'message_id': next(self.update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+            **({'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}
+               if text.startswith('/') else {}),
+        })
+
+    def callback_update(self, user_id: int, message, data: str):
+        return self.update(callback_query={
+            'id': str(next(self.update_ids)), 'chat_instance': str(user_id), 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'message': message,
+        })
+
+    async def post(self, client: httpx.AsyncClient, update):
+        started = time.perf_counter()
+        while True:
+            response = await client.post(self.args.webhook_url, json=update)
+            if response.status_code != 503:
+                break
+            # Update queue full; Telegram would redeliver, so do the same
+            await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+        self.ack_latency.append(time.perf_counter() - started)
+        response.raise_for_status()
+
+    async def expect(self, queue: asyncio.Queue, kinds):
+        deadline = time.monotonic() + self.args.timeout
+        while True:
+            kind, payload, at = await asyncio.wait_for(queue.get(), max(0.0, deadline - time.monotonic()))
+            if kind in kinds:
+                return kind, payload, at
+
+    def count(self, outcome: str):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def run_user(self, client, user_id: int, jobs: asyncio.Queue):
+        queue = self.events.setdefault(user_id, asyncio.Queue())
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                if self.args.scenario == 'start':
+                    await self.run_start(client, user_id, queue)
+                elif self.args.scenario == 'batch':
+                    await self.run_batch(client, user_id, queue, job)
+                else:
+                    await self.run_download(client, user_id, queue, job)
+            except asyncio.TimeoutError:
+                self.count('timeout')
+
+    async def run_start(self, client, user_id: int, queue):
+        started = time.perf_counter()
+        await self.post(client, self.text_update(user_id, '/start'))
+        _, _, at = await self.expect(queue, ('message', 'prompt'))
+        self.total_latency.append(at - started)
+        self.count('ok')
+
+    async def run_download(self, client, user_id: int, queue, job):
+        url, media = job
+        started = time.perf_counter()
+        await self.post(client, self.text_update(user_id, url))
+        kind, prompt, prompted_at = await self.expect(queue, ('prompt', 'error'))
+        if kind == 'error':
+            self.count('error')
+            return
+        self.prompt_latency.append(prompted_at - started)
+        data = next((button for button in prompt['buttons'] if button.startswith(f'download_{media}_')), None)
+        if data is None:
+            self.count('no_button')
+            return
+
+        tapped = time.perf_counter()
+        await self.post(client, self.callback_update(user_id, prompt['message'], data))
+        kind, _, done_at = await self.expect(queue, ('media', 'error'))
+        if kind == 'error':
+            self.count('error')
+            return
+        # For media split into parts this is when the first part arrives
+        self.media_latency.append(done_at - tapped)
+        self.total_latency.append(done_at - started)
+        self.count('ok')
+
+    async def run_batch(self, client, user_id: int, queue, job):
+        urls, media = job
+        started = time.perf_counter()
+        await self.post(client, self.text_update(user_id, '\n'.join(urls)))
+        kind, prompt, prompted_at = await self.expect(queue, ('prompt', 'error'))
+        if kind == 'error':
+            self.count('error')
+            return
+        self.prompt_latency.append(prompted_at - started)
+        data = next((button for button in prompt['buttons'] if button.startswith(f'batch_{media}_')), None)
+        if data is None:
+            self.count('no_button')
+            return
+
+        tapped = time.perf_counter()
+        await self.post(client, self.callback_update(user_id, prompt['message'], data))
+        _, status, done_at = await self.expect(queue, ('batch_done',))
+        self.media_latency.append(done_at - tapped)
+        self.total_latency.append(done_at - started)
+        self.count('ok' if '❌' not in status else 'partial')
+
+    def jobs(self):
+        rng = random.Random(self.args.seed)
+        jobs = asyncio.Queue()
+        links = self.args.batch_size if self.args.scenario == 'batch' else 1
+        for _ in range(self.args.requests):
+            urls = [
+                f"{self.args.media_url}/clip-{rng.randrange(self.args.distinct_urls)}-{index}.mp4"
+                for index in range(links)
+            ]
+            media = 'audio' if rng.random() < self.args.audio_ratio else 'video'
+            jobs.put_nowait((urls if self.args.scenario == 'batch' else urls[0], media))
+        return jobs
+
+    async def run(self):
+        jobs = self.jobs()
+        limits = httpx.Limits(max_connections=self.args.users, max_keepalive_connections=self.args.users)
+        async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+            await asyncio.gather(*(
+                self.run_user(client, 1000 + user, jobs) for user in range(self.args.users)
+            ))
+
+
+def percentiles(values):
+    if not values:
+        return 'n=0'
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))] * 1000
+
+    return f"n={len(values):<5} p50={pick(0.5):8.1f}ms p95={pick(0.95):8.1f}ms p99={pick(0.99):8.1f}ms"
+
+
+# --- Bot process ---
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_bot(work_dir: str, port: int, api_url: str, overrides):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': api_url,
+        'WEBHOOK_BASE_URL': '',
+        'FORCE_CHANNEL_ID': '',
+        'ANALYTICS_DB': os.path.join(work_dir, 'analytics.db'),
+        'FILE_CACHE_DB': os.path.join(work_dir, 'file_cache.db'),
+        'WORK_DIR': os.path.join(work_dir, 'downloads'),
+    })
+    env.update(overrides)
+    log = open(os.path.join(work_dir, 'bot.log'), 'wb')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'main.py')], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"bot exited during start-up; see {log.name}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"bot did not start; see {log.name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=('download', 'batch', 'start'), default='download')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--requests', type=int, default=50, help='total requests across all users')
+    parser.add_argument('--distinct-urls', type=int, default=20, help='fewer URLs than requests exercises the caches')
+    parser.add_argument('--batch-size', type=int, default=5, help='links per message in the batch scenario')
+    parser.add_argument('--audio-ratio', type=float, default=0.3)
+    parser.add_argument('--size-kb', type=int, default=1024)
+    parser.add_argument('--timeout', type=float, default=120, help='per-step timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='bot setting override')
+    parser.add_argument('--metrics-out', help='save the final /metrics scrape to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory (bot.log, databases)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='vidxpress-bench-')
+    clip = os.path.join(work_dir, 'clip.mp4')
+    make_clip(clip, args.size_kb)
+    MediaHandler.clip_path = clip
+    media_server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=media_server.serve_forever, daemon=True).start()
+    args.media_url = f"http://127.0.0.1:{media_server.server_address[1]}"
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    events = {}
+
+    def on_event(chat_id, kind, payload, at):
+        queue = events.get(chat_id)
+        if queue is not None:
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, payload, at))
+        elif chat_id is None and kind == 'error':
+            # Alerts don't say which chat they were for
+            print(f"alert: {payload}")
+
+    stub = StubBotAPI(on_event)
+    port = free_port()
+    overrides = dict(item.split('=', 1) for item in args.env)
+    process = start_bot(work_dir, port, stub.url, overrides)
+    args.webhook_url = f"http://127.0.0.1:{port}/{BOT_TOKEN}"
+
+    test = LoadTest(args, events)
+    sampler = UsageSampler(process.pid)
+    try:
+        async def run():
+            sampler.start()
+            started = time.perf_counter()
+            await test.run()
+            elapsed = time.perf_counter() - started
+            return elapsed, sampler.stop()
+
+        elapsed, cpu = loop.run_until_complete(run())
+        if args.metrics_out:
+            with open(args.metrics_out, 'w') as f:
+                f.write(httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=10).text)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        stub.close()
+        media_server.shutdown()
+        loop.close()
+        if args.keep:
+            print(f"work directory: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"scenario={args.scenario} users={args.users} requests={args.requests} "
+          f"distinct_urls={args.distinct_urls} size={args.size_kb}KB")
+    print(f"outcomes            {test.outcomes}")
+    print(f"webhook ack         {percentiles(test.ack_latency)}")
+    if args.scenario != 'start':
+        print(f"link -> prompt      {percentiles(test.prompt_latency)}")
+        print(f"tap -> upload       {percentiles(test.media_latency)}")
+    print(f"end to end          {percentiles(test.total_latency)}")
+    print(f"throughput          {test.updates_sent / elapsed:.1f} updates/s, "
+          f"{test.outcomes.get('ok', 0) / elapsed:.1f} completed requests/s over {elapsed:.1f}s")
+    print(f"bot resources       cpu={cpu:.1f}s ({cpu / elapsed * 100:.0f}% of one core) "
+          f"peak_rss={sampler.peak_rss / 1024 / 1024:.0f}MB uploaded={stub.uploaded_bytes / 1024 / 1024:.1f}MB")
+    print(f"bot api calls       {dict(sorted(stub.calls.items()))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure the CPU cost of the media pipeline's operations per minute of output.
+
+Generates a synthetic clip with ffmpeg (no network needed) and runs the
+remux, the compatibility re-encode and size-fitting re-encodes for a few
+limits on it:
+
+    python benchmarks/bench_transcode.py --seconds 60 --height 720 --limits-mb 50 20 10
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from format_selection import FIT_HEIGHTS, FIT_HEADROOM, FIT_VIDEO_AUDIO_KBPS  # noqa: E402
+from media_pipeline import (  # noqa: E402
+    REMUX, TRANSCODE, ffmpeg_command, fit_command, probe_streams, run_ffmpeg, split_command
+)
+
+
+def make_clip(path: str, seconds: int, height: int, codec: str) -> None:
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={height * 16 // 9}x{height}:rate=30:duration={seconds}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:v', codec, '-c:a', 'libopus' if codec == 'libvpx-vp9' else 'aac', '-shortest', path
+    ], check=True)
+
+
+def measure(name: str, cmd, output_seconds: float, threads_note: str = '') -> None:
+    started = time.perf_counter()
+    cpu = run_ffmpeg(cmd)
+    wall = time.perf_counter() - started
+    per_minute = cpu / (output_seconds / 60)
+    print(f"{name:<28} wall={wall:7.2f}s cpu={cpu:7.2f}s cpu/output-min={per_minute:7.2f}s {threads_note}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--limits-mb', type=float, nargs='+', default=[50, 20, 10],
+                        help='size limits to fit the clip into (scaled to the clip length as if it were 1h)')
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg'):
+        sys.exit('ffmpeg is required for this benchmark')
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        h264 = os.path.join(work_dir, 'source.mp4')
+        vp9 = os.path.join(work_dir, 'source.webm')
+        make_clip(h264, args.seconds, args.height, 'libx264')
+        make_clip(vp9, args.seconds, args.height, 'libvpx-vp9')
+
+        streams = probe_streams(h264)
+        measure('remux mp4 -> mkv',
+                ffmpeg_command(h264, os.path.join(work_dir, 'remux.mkv'), REMUX, 'video', streams, args.threads),
+                args.seconds)
+        streams = probe_streams(vp9)
+        measure('transcode vp9 -> h264',
+                ffmpeg_command(vp9, os.path.join(work_dir, 'compat.mp4'), TRANSCODE, 'video', streams, args.threads),
+                args.seconds, f'threads={args.threads}')
+
+        for limit_mb in args.limits_mb:
+            # Plan as format_selection would for an hour-long video under this limit
+            video_kbps = limit_mb * 1024 * 1024 * FIT_HEADROOM * 8 / 1000 / 3600 - FIT_VIDEO_AUDIO_KBPS
+            if video_kbps <= 0:
+                print(f"fit {limit_mb:g}MB/h{'':<19} too small to re-encode; would be split")
+                continue
+            height = next(height for kbps, height in FIT_HEIGHTS if video_kbps >= kbps)
+            fit = {'video_kbps': int(video_kbps), 'audio_kbps': FIT_VIDEO_AUDIO_KBPS, 'height': height}
+            output = os.path.join(work_dir, f'fit-{limit_mb:g}.mp4')
+            measure(f'fit {limit_mb:g}MB/h ({int(video_kbps)}k, {height}p)',
+                    fit_command(h264, output, 'video', fit, args.threads), args.seconds, f'threads={args.threads}')
+
+        measure('split into 4 parts',
+                split_command(h264, os.path.join(work_dir, 'part%03d.mp4'), args.seconds / 4), args.seconds)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import subprocess
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional, Callable
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
+
+logger = logging.getLogger(__name__)
+
+# Used when no probe picked a format: H.264 + M4A merged without re-encoding, else any progressive MP4
+VIDEO_FORMAT = 'bv*[ext=mp4][vcodec^=avc1]+ba[ext=m4a]/b[ext=mp4]/bv*+ba/b'
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+# Separate streams are merged by stream copy; MediaPipeline handles any conversion after that
+MERGE_FORMAT = 'mp4'
+
+# How often the CLI engine checks the size of its output directory
+SIZE_POLL_INTERVAL = 0.5
+# Least time between progress reports sent back from a download worker
+PROGRESS_INTERVAL = 0.5
+
+
+class FileTooLarge(Exception):
+    """Raised as soon as a download is known to exceed the size limit."""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(
+            f'File size ({size / 1024 / 1024:.2f}MB) exceeds limit ({limit / 1024 / 1024:.2f}MB)'
+        )
+        self.size = size
+        self.limit = limit
+
+    def __reduce__(self):
+        # Keep the exception picklable across the process pool
+        return (FileTooLarge, (self.size, self.limit))
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            total += entry.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def progress_event(downloaded: int, total: Optional[int], speed: Optional[float],
+                   eta: Optional[float] = None) -> Dict[str, Any]:
+    """A 'downloading' progress report; ETA is derived from the speed when not given."""
+    if eta is None and speed and total and total > downloaded:
+        eta = (total - downloaded) / speed
+    return {
+        'stage': 'downloading',
+        'downloaded_bytes': downloaded,
+        'total_bytes': total,
+        'speed': speed,
+        'eta': eta,
+    }
+
+
+def run_with_size_limit(cmd, temp_dir: str, max_bytes: Optional[int],
+                        on_progress: Optional[ProgressCallback] = None, total_bytes: Optional[int] = None) -> None:
+    """
+    Run a CLI download, killing it once its output grows past `max_bytes`.
+
+    The size of the output directory doubles as progress for `on_progress`
+    (against `total_bytes`, the probed size), since the CLI offers no hooks.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = b''
+    last_size, last_time = 0, time.monotonic()
+    try:
+        while True:
+            try:
+                _, stderr = process.communicate(timeout=SIZE_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if max_bytes is None and on_progress is None:
+                    continue
+                size = directory_size(temp_dir)
+                if on_progress:
+                    now = time.monotonic()
+                    speed = (size - last_size) / (now - last_time) if now > last_time else None
+                    on_progress(progress_event(size, total_bytes, speed))
+                    last_size, last_time = size, now
+                if max_bytes is not None and size > max_bytes:
+                    process.kill()
+                    process.wait()
+                    raise FileTooLarge(size, max_bytes)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+
+
+class SubprocessEngine:
+    """Runs the yt-dlp CLI once per download (fallback backend)."""
+
+    name = 'subprocess'
+
+    def probe(self, url: str, playlist_end: Optional[int] = None) -> Dict[str, Any]:
+        """Extract metadata without downloading; playlists are listed flat, up to `playlist_end` entries."""
+        cmd = ['yt-dlp', '-J', '--no-playlist', '--flat-playlist']
+        if playlist_end:
+            cmd += ['--playlist-end', str(playlist_end)]
+        result = subprocess.run([*cmd, url], check=True, capture_output=True)
+        return json.loads(result.stdout)
+
+    def _source_args(self, url: str, temp_dir: str, info: Optional[Dict[str, Any]]):
+        """Reuse probed metadata via --load-info-json instead of extracting again."""
+        if not info:
+            return [url]
+        info_path = os.path.join(temp_dir, 'probe.info.json')
+        with open(info_path, 'w') as f:
+            json.dump(info, f)
+        return ['--load-info-json', info_path]
+
+    def download_video(self, url: str, temp_dir: str, max_bytes: Optional[int] = None,
+                       info: Optional[Dict[str, Any]] = None, format_id: Optional[str] = None,
+                       on_progress: Optional[ProgressCallback] = None,
+                       total_bytes: Optional[int] = None) -> Optional[str]:
+        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
+
+        cmd = [
+            'yt-dlp',
+            '-f', format_id or VIDEO_FORMAT,
+            '--merge-output-format', MERGE_FORMAT,
+            '-o', output_template,
+            *self._source_args(url, temp_dir, info)
+        ]
+
+        run_with_size_limit(cmd, temp_dir, max_bytes, on_progress, total_bytes)
+
+        # Find the downloaded file
+        for file in os.listdir(temp_dir):
+            if file.endswith(('.mp4', '.mkv', '.webm', '.mov', '.avi')):
+                return os.path.join(temp_dir, file)
+
+        return None
+
+    def download_audio(self, url: str, temp_dir: str, max_bytes: Optional[int] = None,
+                       info: Optional[Dict[str, Any]] = None, format_id: Optional[str] = None,
+                       on_progress: Optional[ProgressCallback] = None,
+                       total_bytes: Optional[int] = None) -> Optional[str]:
+        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
+
+        cmd = [
+            'yt-dlp',
+            '-f', format_id or AUDIO_FORMAT,
+            '-o', output_template,
+            *self._source_args(url, temp_dir, info)
+        ]
+
+        run_with_size_limit(cmd, temp_dir, max_bytes, on_progress, total_bytes)
+
+        # Find the downloaded audio file
+        for file in os.listdir(temp_dir):
+            if file.endswith(('.m4a', '.mp3', '.webm', '.opus', '.ogg', '.mp4', '.aac')):
+                return os.path.join(temp_dir, file)
+
+        return None
+
+    def shutdown(self) -> None:
+        pass
+
+
+# --- In-process worker side ---
+
+def _warm_worker() -> None:
+    """Pool initializer: import yt-dlp and its extractor classes once per worker."""
+    import yt_dlp
+    from yt_dlp.extractor import gen_extractor_classes
+    gen_extractor_classes()
+    yt_dlp.YoutubeDL({'quiet': True}).close()
+
+
+def _noop() -> None:
+    pass
+
+
+def _size_guard(max_bytes: int):
+    """Progress hook that aborts the download once it is known to exceed `max_bytes`."""
+    def hook(progress: Dict[str, Any]) -> None:
+        if progress.get('status') != 'downloading':
+            return
+        size = max(progress.get('total_bytes') or 0, progress.get('downloaded_bytes') or 0)
+        if size > max_bytes:
+            raise FileTooLarge(size, max_bytes)
+    return hook
+
+
+def _progress_reporter(progress_queue):
+    """Progress hook that sends at most one 'downloading' report per PROGRESS_INTERVAL to the parent."""
+    last_sent = [0.0]
+
+    def hook(progress: Dict[str, Any]) -> None:
+        if progress.get('status') != 'downloading':
+            return
+        now = time.monotonic()
+        if now - last_sent[0] < PROGRESS_INTERVAL:
+            return
+        last_sent[0] = now
+        progress_queue.put(progress_event(
+            progress.get('downloaded_bytes') or 0,
+            progress.get('total_bytes') or progress.get('total_bytes_estimate'),
+            progress.get('speed'), progress.get('eta')
+        ))
+    return hook
+
+
+def _run_probe(url: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract metadata for `url` inside a pool worker."""
+    import yt_dlp
+
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+
+
+def _run_ytdlp(url: str, options: Dict[str, Any], max_bytes: Optional[int] = None,
+               info: Optional[Dict[str, Any]] = None, progress_queue=None) -> Optional[str]:
+    """
+    Download `url` with YoutubeDL inside a pool worker and return the final file path.
+
+    When `info` from an earlier probe is given, it is processed directly so the
+    extractor does not run a second time.
+    """
+    import yt_dlp
+
+    # Hooks are closures, so they are built here rather than pickled with the options
+    hooks = []
+    if max_bytes is not None:
+        hooks.append(_size_guard(max_bytes))
+    if progress_queue is not None:
+        hooks.append(_progress_reporter(progress_queue))
+    if hooks:
+        options = dict(options, progress_hooks=hooks)
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            if info:
+                info = ydl.process_ie_result(info, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+    except FileTooLarge:
+        raise
+    except Exception as e:
+        # yt-dlp errors carry tracebacks that cannot be pickled back to the parent
+        raise RuntimeError(str(e)) from None
+
+    if not info:
+        return None
+    # Merging updates the path on the requested download
+    downloads = info.get('requested_downloads') or []
+    if downloads:
+        return downloads[-1].get('filepath')
+    return info.get('filepath')
+
+
+class InProcessEngine:
+    """
+    Drives yt_dlp.YoutubeDL inside a pool of long-lived worker processes.
+
+    Workers import yt-dlp and its extractors once at startup, so a request only
+    pays for network I/O instead of interpreter start-up and extractor import.
+    """
+
+    name = 'inprocess'
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_worker
+        )
+        # Start the workers now so the first request doesn't pay for the warm-up
+        self._pool.submit(_noop)
+        # Progress reports come back through queues of a manager process, started on first use
+        self._manager = None
+        self._manager_lock = threading.Lock()
+
+    def _options(self, temp_dir: Optional[str]) -> Dict[str, Any]:
+        options = {
+            'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+        }
+        if temp_dir:
+            options['outtmpl'] = os.path.join(temp_dir, '%(title)s.%(ext)s')
+        return options
+
+    def probe(self, url: str, playlist_end: Optional[int] = None) -> Dict[str, Any]:
+        """Extract metadata without downloading; playlists are listed flat, up to `playlist_end` entries."""
+        options = self._options(None)
+        # Only list a playlist's entries; each one is probed when it is downloaded
+        options['extract_flat'] = 'in_playlist'
+        if playlist_end:
+            options['playlistend'] = playlist_end
+        return self._pool.submit(_run_probe, url, options).result()
+
+    def _progress_queue(self):
+        with self._manager_lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context('spawn').Manager()
+            return self._manager.Queue()
+
+    def _download(self, url: str, options: Dict[str, Any], max_bytes: Optional[int],
+                  info: Optional[Dict[str, Any]], on_progress: Optional[ProgressCallback]) -> Optional[str]:
+        if on_progress is None:
+            return self._pool.submit(_run_ytdlp, url, options, max_bytes, info).result()
+
+        # Relay the worker's reports to `on_progress` on this (the caller's) thread
+        progress_queue = self._progress_queue()
+        future = self._pool.submit(_run_ytdlp, url, options, max_bytes, info, progress_queue)
+        while True:
+            try:
+                on_progress(progress_queue.get(timeout=SIZE_POLL_INTERVAL))
+            except queue.Empty:
+                if future.done():
+                    break
+        return future.result()
+
+    def download_video(self, url: str, temp_dir: str, max_bytes: Optional[int] = None,
+                       info: Optional[Dict[str, Any]] = None, format_id: Optional[str] = None,
+                       on_progress: Optional[ProgressCallback] = None,
+                       total_bytes: Optional[int] = None) -> Optional[str]:
+        options = self._options(temp_dir)
+        options['format'] = format_id or VIDEO_FORMAT
+        options['merge_output_format'] = MERGE_FORMAT
+        return self._download(url, options, max_bytes, info, on_progress)
+
+    def download_audio(self, url: str, temp_dir: str, max_bytes: Optional[int] = None,
+                       info: Optional[Dict[str, Any]] = None, format_id: Optional[str] = None,
+                       on_progress: Optional[ProgressCallback] = None,
+                       total_bytes: Optional[int] = None) -> Optional[str]:
+        options = self._options(temp_dir)
+        options['format'] = format_id or AUDIO_FORMAT
+        return self._download(url, options, max_bytes, info, on_progress)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+
+def create_engine(name: str = 'inprocess', workers: int = 2):
+    """Build the configured download engine, falling back to the CLI if yt_dlp is not importable."""
+    if name == InProcessEngine.name:
+        if importlib.util.find_spec('yt_dlp') is not None:
+            return InProcessEngine(workers=workers)
+        logger.warning("yt_dlp module not importable; falling back to the subprocess engine")
+    elif name != SubprocessEngine.name:
+        logger.warning(f"Unknown download engine '{name}'; using the subprocess engine")
+    return SubprocessEngine()
@@ -1,43 +1,311 @@
 import os
+import time
 import logging
-import subprocess
 import tempfile
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional
+
+from download_engines import create_engine, FileTooLarge, ProgressCallback
+from extractor_health import ExtractorHealth, CircuitOpen, CIRCUIT_OPEN_MESSAGE, backoff_delay
+from file_cache import canonicalize_url
+from format_selection import summarize_probe
+from media_pipeline import MediaPipeline
+from storage import StorageManager
+from metrics import REGISTRY, STAGE_SECONDS
+from scheduler import RetryLater
+from ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+DOWNLOADS = REGISTRY.counter(
+    'vidxpress_downloads_total', 'Download jobs by outcome, error class and extractor',
+    labels=('media', 'outcome', 'error_class', 'extractor')
+)
+DOWNLOADED_BYTES = REGISTRY.counter(
+    'vidxpress_downloaded_bytes_total', 'Bytes fetched from media sites', labels=('media',)
+)
+PROBES = REGISTRY.counter(
+    'vidxpress_probes_total', 'Extractor runs for metadata by outcome', labels=('outcome', 'extractor')
+)
+
+
+def classify_error(error) -> str:
+    """Coarse, low-cardinality category for an error message."""
+    text = str(error or '').lower()
+    if CIRCUIT_OPEN_MESSAGE in text:
+        return 'circuit_open'
+    if 'exceeds limit' in text:
+        return 'too_large'
+    if 'sign in' in text or 'login' in text or 'cookies' in text:
+        return 'login_required'
+    if 'unsupported url' in text or 'no compatible format' in text or 'requested format' in text:
+        return 'unsupported'
+    if '429' in text or 'too many requests' in text or 'rate limit' in text:
+        return 'rate_limited'
+    # Before 'unavailable': "HTTP Error 503: Service Unavailable" is the site, not the video
+    if 'http error 5' in text:
+        return 'server_error'
+    if 'private' in text or 'unavailable' in text or 'removed' in text or '404' in text:
+        return 'unavailable'
+    if ('timed out' in text or 'timeout' in text or 'connection' in text or 'network' in text
+            or 'urlopen error' in text or 'unable to download webpage' in text):
+        return 'network'
+    if 'busy' in text:
+        return 'busy'
+    if 'ffmpeg' in text or 'split' in text:
+        return 'postprocess'
+    return 'other'
+
 class DownloadManager:
-    def __init__(self, max_file_size_bytes: int = 50 * 1024 * 1024):
+    def __init__(self, max_file_size_bytes: int = 50 * 1024 * 1024, engine: str = 'inprocess',
+                 engine_workers: int = 2, probe_ttl: float = 600, transcode_workers: int = 1,
+                 transcode_threads: int = 2, fit_max_parts: int = 0, fit_max_source_bytes: int = 500 * 1024 * 1024,
+                 storage: Optional[StorageManager] = None, playlist_max_items: int = 10,
+                 health: Optional[ExtractorHealth] = None, max_attempts: int = 3,
+                 retry_base_delay: float = 1.0, retry_max_delay: float = 10.0, probe_failure_ttl: float = 60):
         self.max_file_size_bytes = max_file_size_bytes
+        # Only this many entries of a playlist are listed when probing it
+        self.playlist_max_items = playlist_max_items
+        # Oversized media is re-encoded or split into at most this many parts (0 disables)
+        self.fit_max_parts = fit_max_parts
+        self.fit_max_source_bytes = fit_max_source_bytes
         self.logger = logging.getLogger('DownloadManager')
+        self.engine = create_engine(engine, workers=engine_workers)
+        self.logger.info(f"Using {self.engine.name} download engine")
+        self.pipeline = MediaPipeline(max_transcodes=transcode_workers, threads=transcode_threads)
+        self.storage = storage or StorageManager(
+            os.path.join(tempfile.gettempdir(), 'vidxpress'), budget_bytes=4 * max_file_size_bytes
+        )
+        # Format URLs in probed metadata expire, so probes are only reused briefly
+        self.probe_cache = TTLCache(max_entries=1000, default_ttl=probe_ttl)
+        # Failed probes are kept too, so the download right after a failed prefetch doesn't run it again
+        self.probe_failure_ttl = probe_failure_ttl
+        self._active_lock = threading.Lock()
+        # yt-dlp runs (probes and downloads) currently in progress
+        self.active = 0
+        # Transient extractor errors are retried up to max_attempts runs in total
+        self.health = health or ExtractorHealth()
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+    def _run_engine(self, stage: str, func, *args, **kwargs):
+        """Call the engine, keeping the active count and the stage timing."""
+        with self._active_lock:
+            self.active += 1
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            STAGE_SECONDS.observe(time.monotonic() - started, stage=stage)
+            with self._active_lock:
+                self.active -= 1
+
+    def _run_extractor(self, url: str, stage: str, attempt: int, func, *args, **kwargs):
+        """
+        Run the engine against `url`'s site through its circuit breaker.
 
-    def download(self, url: str, audio_only: bool = False) -> Dict[str, Any]:
+        Raises CircuitOpen without running anything while the site is failing.
+        A transient error on attempt `attempt` raises RetryLater, so the
+        scheduler frees the slot during the backoff and runs the job again.
+        """
+        key = self.health.key_for(url)
+        self.health.before_call(key)
+        try:
+            result = self._run_engine(stage, func, *args, **kwargs)
+        except FileTooLarge:
+            # The site answered; the file just doesn't fit
+            self.health.record(key)
+            raise
+        except Exception as e:
+            error_class = classify_error(e)
+            if attempt < self.max_attempts and self.health.allow_retry(key, error_class):
+                # Rate limits get a longer wait than dropped connections
+                base = self.retry_base_delay * (4 if error_class == 'rate_limited' else 1)
+                delay = backoff_delay(attempt, base, self.retry_max_delay)
+                self.logger.info(f"{stage} of {url} failed ({error_class}), retry {attempt} in {delay:.1f}s")
+                raise RetryLater(delay, attempt=attempt + 1) from e
+            self.health.record(key, error_class, e)
+            raise
+        self.health.record(key)
+        return result
+
+    def probe(self, url: str, attempt: int = 1) -> Dict[str, Any]:
+        """
+        Fetch metadata for URL and choose formats that fit the size limit.
+        
+        Results are cached per canonical URL so that the format prompt and the
+        later download share one extractor run. Raises RetryLater on a
+        transient error that will be retried (`attempt` counts the runs).
+        
+        Returns:
+            Dictionary with 'success' and 'error' keys plus, on success, 'title',
+            'duration', 'extractor', 'id', 'info' and per-format
+            '{video,audio}_format', '_size' and '_error' keys. On failure,
+            'extractor_failed' is True when yt-dlp itself failed or was not run
+        """
+        key = canonicalize_url(url)
+        cached = self.probe_cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            info = self._run_extractor(
+                url, 'probe', attempt, self.engine.probe, url, playlist_end=self.playlist_max_items
+            )
+        except RetryLater:
+            raise
+        except CircuitOpen as e:
+            PROBES.inc(outcome='circuit_open', extractor=e.key)
+            return {'success': False, 'error': str(e), 'extractor_failed': True}
+        except Exception as e:
+            self.logger.error(f"Probe error: {str(e)}")
+            PROBES.inc(outcome=classify_error(e), extractor='unknown')
+            result = {'success': False, 'error': str(e), 'extractor_failed': True}
+            self.probe_cache.set(key, result, ttl=self.probe_failure_ttl)
+            return result
+        try:
+            # Merging, re-encoding and splitting all need ffmpeg
+            result = summarize_probe(
+                info,
+                self.max_file_size_bytes,
+                allow_merge=self.pipeline.available,
+                fit_max_parts=self.fit_max_parts if self.pipeline.available else 0,
+                fit_max_source_bytes=self.fit_max_source_bytes
+            )
+        except Exception as e:
+            self.logger.error(f"Probe error: {str(e)}")
+            PROBES.inc(outcome=classify_error(e), extractor='unknown')
+            return {'success': False, 'error': str(e), 'extractor_failed': False}
+        PROBES.inc(outcome='success', extractor=result['extractor'] or 'unknown')
+        self.health.learn(url, result['extractor'])
+        self.probe_cache.set(key, result)
+        return result
+
+    def needs_transcode(self, url: str, media: str) -> bool:
+        """Whether a download of `url` is expected to be re-encoded, from the cached probe if any."""
+        probe = self.probe_cache.get(canonicalize_url(url))
+        return bool(probe and probe['success'] and probe[f'{media}_transcode'])
+
+    def download(self, url: str, audio_only: bool = False,
+                 on_progress: Optional[ProgressCallback] = None, attempt: int = 1) -> Dict[str, Any]:
         """
         Download video or audio from URL.
         
         Args:
             url: The video URL to download
             audio_only: If True, extract only audio; if False, download video
+            on_progress: Called (on the calling thread) with {'stage', ...} as the
+                job moves through resolving, downloading and converting
+            attempt: Runs of this job so far, including this one; a transient
+                error raises RetryLater for the scheduler to run it again
             
         Returns:
-            Dictionary with 'success', 'file_path', 'temp_dir', and 'error' keys
+            Dictionary with 'success', 'file_path', 'temp_dir', and 'error' keys,
+            plus 'processing' (keep/remux/transcode/bitrate/split), 'cpu_seconds'
+            and, when the media was split to fit, the ordered 'parts' on success
         """
-        temp_dir = None
-        file_path = None
+        media = 'audio' if audio_only else 'video'
+        started = time.monotonic()
+        if on_progress:
+            on_progress({'stage': 'resolving'})
+        probe = self.probe(url, attempt)
+        result = self._download(url, media, probe, on_progress, attempt)
+        STAGE_SECONDS.observe(time.monotonic() - started, stage='download_job')
+        DOWNLOADS.inc(
+            media=media,
+            outcome='success' if result['success'] else 'failure',
+            error_class='none' if result['success'] else classify_error(result['error']),
+            extractor=probe.get('extractor') or 'unknown'
+        )
+        return result
+
+    def _download(self, url: str, media: str, probe: Dict[str, Any],
+                  on_progress: Optional[ProgressCallback], attempt: int) -> Dict[str, Any]:
+        audio_only = media == 'audio'
+        # Reject impossible requests before fetching anything
+        fit = None
+        # Without probed info the download would run the same failed extraction again
+        if not probe['success'] and probe.get('extractor_failed'):
+            return {
+                'success': False,
+                'file_path': None,
+                'temp_dir': None,
+                'error': probe['error']
+            }
+        if probe['success']:
+            fit = probe[f'{media}_fit']
+            if not probe[f'{media}_format']:
+                return {
+                    'success': False,
+                    'file_path': None,
+                    'temp_dir': None,
+                    'error': probe[f'{media}_error']
+                }
         
+        # Wait for room in the disk budget before fetching anything
+        started = time.monotonic()
+        temp_dir = self.storage.acquire(
+            self._reservation_size(probe, media, fit), prefer_memory=audio_only and not fit
+        )
+        STAGE_SECONDS.observe(time.monotonic() - started, stage='storage_wait')
+        if temp_dir is None:
+            return {
+                'success': False,
+                'file_path': None,
+                'temp_dir': None,
+                'error': 'Server is busy. Please try again in a few minutes.'
+            }
+
         try:
-            # Create a temporary directory for this download
-            temp_dir = tempfile.mkdtemp()
-            
+            result = self._fetch(url, temp_dir, media, probe, fit, on_progress, attempt)
+        except RetryLater:
+            # The retry starts over with a fresh reservation
+            self.storage.release(temp_dir)
+            raise
+        if not result['success']:
+            # Clean up failures here so no error path can leak the job directory
+            self.storage.release(temp_dir)
+            result['temp_dir'] = None
+        return result
+
+    def _reservation_size(self, probe: Dict[str, Any], media: str, fit) -> int:
+        """Disk to reserve for a job: the download plus a post-processed copy of it."""
+        if fit:
+            return fit['source_size'] * 2
+        if probe['success'] and probe[f'{media}_size']:
+            return probe[f'{media}_size'] * 2
+        return self.max_file_size_bytes * 2
+
+    def _fetch(self, url: str, temp_dir: str, media: str, probe: Dict[str, Any], fit,
+               on_progress: Optional[ProgressCallback], attempt: int) -> Dict[str, Any]:
+        """Download into `temp_dir` and post-process; returns the same dict as `download`."""
+        audio_only = media == 'audio'
+        try:
+            # A source that is going to be shrunk may be larger than the limit itself
+            max_bytes = self.fit_max_source_bytes if fit else self.max_file_size_bytes
             if audio_only:
                 # Download audio only
-                file_path = self._download_audio(url, temp_dir)
+                file_path = self._download_audio(url, temp_dir, probe, max_bytes, attempt, on_progress)
             else:
                 # Download video
-                file_path = self._download_video(url, temp_dir)
+                file_path = self._download_video(url, temp_dir, probe, max_bytes, attempt, on_progress)
             
             if file_path and os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
+                DOWNLOADED_BYTES.inc(os.path.getsize(file_path), media=media)
+                if on_progress and self.pipeline.available:
+                    on_progress({'stage': 'converting'})
+                started = time.monotonic()
+                if fit:
+                    # Re-encode to a lower bitrate and/or split into parts that fit
+                    processed = self.pipeline.fit(file_path, media, fit, self.max_file_size_bytes)
+                else:
+                    # Remux or re-encode only if Telegram couldn't play the file as downloaded
+                    processed = self.pipeline.process(file_path, media)
+                    processed['file_paths'] = [processed['file_path']]
+                STAGE_SECONDS.observe(time.monotonic() - started, stage='postprocess')
+                parts = processed['file_paths']
+                file_path = parts[0]
+                file_size = max(os.path.getsize(part) for part in parts)
                 
                 if file_size > self.max_file_size_bytes:
                     return {
@@ -51,7 +319,10 @@ class DownloadManager:
                     'success': True,
                     'file_path': file_path,
                     'temp_dir': temp_dir,
-                    'error': None
+                    'error': None,
+                    'processing': processed['action'],
+                    'cpu_seconds': processed['cpu_seconds'],
+                    'parts': parts if len(parts) > 1 else None
                 }
             else:
                 return {
@@ -61,6 +332,19 @@ class DownloadManager:
                     'error': 'Failed to download file'
                 }
         
+        except RetryLater:
+            raise
+
+        except FileTooLarge as e:
+            # Aborted mid-download instead of fetching the whole oversized file
+            self.logger.info(f"Download aborted early: {e}")
+            return {
+                'success': False,
+                'file_path': None,
+                'temp_dir': temp_dir,
+                'error': str(e)
+            }
+        
         except Exception as e:
             self.logger.error(f"Download error: {str(e)}")
             return {
@@ -70,45 +354,33 @@ class DownloadManager:
                 'error': str(e)
             }
 
-    def _download_video(self, url: str, temp_dir: str) -> str:
-        """Download video using yt-dlp."""
-        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
-        
-        cmd = [
-            'yt-dlp',
-            '-f', 'best[ext=mp4]',
-            '-o', output_template,
-            url
-        ]
-        
-        subprocess.run(cmd, check=True, capture_output=True)
-        
-        # Find the downloaded file
-        for file in os.listdir(temp_dir):
-            if file.endswith(('.mp4', '.mkv', '.webm', '.avi')):
-                return os.path.join(temp_dir, file)
-        
-        return None
+    def _download_video(self, url: str, temp_dir: str, probe: Dict[str, Any], max_bytes: int, attempt: int = 1,
+                        on_progress: Optional[ProgressCallback] = None) -> str:
+        """Download video using the configured yt-dlp engine."""
+        if not probe['success']:
+            # Probing failed; let yt-dlp extract and select the format itself
+            return self._run_extractor(
+                url, 'download', attempt, self.engine.download_video, url, temp_dir, max_bytes=max_bytes, on_progress=on_progress
+            )
+        return self._run_extractor(
+            url, 'download', attempt, self.engine.download_video, url, temp_dir, max_bytes=max_bytes,
+            info=probe['info'], format_id=probe['video_format'],
+            on_progress=on_progress, total_bytes=probe['video_size']
+        )
 
-    def _download_audio(self, url: str, temp_dir: str) -> str:
-        """Download audio using yt-dlp and convert to MP3."""
-        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
-        
-        cmd = [
-            'yt-dlp',
-            '-f', 'bestaudio/best',
-            '-x',  # Extract audio
-            '--audio-format', 'mp3',
-            '--audio-quality', '192',
-            '-o', output_template,
-            url
-        ]
-        
-        subprocess.run(cmd, check=True, capture_output=True)
-        
-        # Find the downloaded audio file
-        for file in os.listdir(temp_dir):
-            if file.endswith('.mp3'):
-                return os.path.join(temp_dir, file)
-        
-        return None
+    def _download_audio(self, url: str, temp_dir: str, probe: Dict[str, Any], max_bytes: int, attempt: int = 1,
+                        on_progress: Optional[ProgressCallback] = None) -> str:
+        """Download the audio stream using the configured yt-dlp engine; MediaPipeline converts it if needed."""
+        if not probe['success']:
+            return self._run_extractor(
+                url, 'download', attempt, self.engine.download_audio, url, temp_dir, max_bytes=max_bytes, on_progress=on_progress
+            )
+        return self._run_extractor(
+            url, 'download', attempt, self.engine.download_audio, url, temp_dir, max_bytes=max_bytes,
+            info=probe['info'], format_id=probe['audio_format'],
+            on_progress=on_progress, total_bytes=probe['audio_size']
+        )
+
+    def shutdown(self) -> None:
+        self.engine.shutdown()
+        self.pipeline.shutdown()
@@ -0,0 +1,244 @@
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RETRIES = REGISTRY.counter(
+    'vidxpress_extractor_retries_total', 'Extractor runs retried after a transient error',
+    labels=('extractor', 'error_class')
+)
+CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    'vidxpress_circuit_transitions_total', 'Extractor circuit breaker state changes', labels=('extractor', 'state')
+)
+CIRCUIT_REJECTED = REGISTRY.counter(
+    'vidxpress_circuit_rejected_total', 'Extractor runs refused while the circuit was open', labels=('extractor',)
+)
+
+# Error classes (see download_manager.classify_error) worth another attempt
+RETRYABLE = frozenset({'network', 'rate_limited', 'server_error'})
+# Classes that say the site itself is broken rather than this one link; others
+# ("video unavailable", "file too large") prove the extractor works
+SITE_FAILURES = RETRYABLE | {'login_required', 'other'}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Hosts that are tracked under the host name until a probe names their extractor
+HOST_PREFIXES = ('www.', 'm.', 'mobile.', 'music.')
+# Extractors that serve unrelated sites are tracked per host instead
+SHARED_EXTRACTORS = frozenset({'Generic'})
+
+CIRCUIT_OPEN_MESSAGE = "downloads are paused after repeated failures"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of running an extractor whose circuit is open."""
+
+    def __init__(self, key: str, retry_in: float):
+        minutes = max(1, round(retry_in / 60))
+        super().__init__(f"{key} {CIRCUIT_OPEN_MESSAGE}. Try again in about {minutes} min.")
+        self.key = key
+        self.retry_in = retry_in
+
+
+def host_key(url: str) -> str:
+    host = (urlsplit(url).hostname or 'unknown').lower()
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: random.Random = random) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2^(attempt-1))]."""
+    return rng.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class _Site:
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.trial_started: Optional[float] = None
+        self.retry_tokens = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0
+        self.trips = 0
+        self.last_error_class: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.last_failure_at: Optional[float] = None
+        self.last_success_at: Optional[float] = None
+
+
+class ExtractorHealth:
+    """
+    Per-extractor circuit breakers and retry budgets.
+
+    Sites are keyed by yt-dlp extractor (learned from successful probes) or,
+    until then, by host. After `failure_threshold` consecutive site-level
+    failures a circuit opens and runs against that site fail immediately for
+    `cooldown` seconds; then one trial run is let through (half-open), which
+    closes the circuit on success or reopens it with a doubled cooldown.
+
+    Retries of transient errors draw on a per-site budget that earns
+    `retry_ratio` of a retry per call, so a site that keeps failing quickly
+    stops being retried instead of multiplying its load.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 60, max_cooldown: float = 900,
+                 retry_ratio: float = 0.2, retry_burst: float = 10, max_sites: int = 256):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.retry_ratio = retry_ratio
+        self.retry_burst = retry_burst
+        self.max_sites = max_sites
+        self.logger = logging.getLogger('ExtractorHealth')
+        self._sites: 'OrderedDict[str, _Site]' = OrderedDict()
+        self._aliases: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def key_for(self, url: str) -> str:
+        host = host_key(url)
+        with self._lock:
+            return self._aliases.get(host, host)
+
+    def learn(self, url: str, extractor: Optional[str]) -> None:
+        """Track `url`'s host under the extractor a probe reported for it."""
+        if not extractor or extractor in SHARED_EXTRACTORS:
+            return
+        host = host_key(url)
+        with self._lock:
+            if self._aliases.get(host) != extractor:
+                if len(self._aliases) >= self.max_sites:
+                    self._aliases.pop(next(iter(self._aliases)))
+                self._aliases[host] = extractor
+
+    def _site(self, key: str) -> _Site:
+        site = self._sites.get(key)
+        if site is None:
+            site = self._sites[key] = _Site()
+            site.retry_tokens = self.retry_burst
+            if len(self._sites) > self.max_sites:
+                # Forget the least recently used healthy site
+                for old_key, old in self._sites.items():
+                    if old.state == CLOSED and old_key != key:
+                        del self._sites[old_key]
+                        break
+        self._sites.move_to_end(key)
+        return site
+
+    def _transition(self, key: str, site: _Site, state: str) -> None:
+        site.state = state
+        CIRCUIT_TRANSITIONS.inc(extractor=key, state=state)
+        self.logger.info(f"Circuit for {key} is now {state}")
+
+    def before_call(self, key: str) -> None:
+        """Admit a run against `key` or raise CircuitOpen."""
+        now = time.monotonic()
+        with self._lock:
+            site = self._site(key)
+            if site.state == OPEN and now >= site.open_until:
+                self._transition(key, site, HALF_OPEN)
+            # A trial that never reported back (its worker died) doesn't block the site forever
+            trial_stale = site.trial_started is not None and now - site.trial_started > self.max_cooldown
+            if site.state == HALF_OPEN and (site.trial_started is None or trial_stale):
+                site.trial_started = now
+            elif site.state != CLOSED:
+                site.rejected += 1
+                CIRCUIT_REJECTED.inc(extractor=key)
+                raise CircuitOpen(key, max(0.0, site.open_until - now))
+            site.calls += 1
+            site.retry_tokens = min(self.retry_burst, site.retry_tokens + self.retry_ratio)
+
+    def allow_retry(self, key: str, error_class: str) -> bool:
+        """Whether a run that failed with `error_class` may be retried now (spends budget if so)."""
+        if error_class not in RETRYABLE:
+            return False
+        with self._lock:
+            site = self._site(key)
+            # A half-open trial gets one shot; retrying it only delays the verdict
+            if site.state != CLOSED or site.retry_tokens < 1:
+                return False
+            site.retry_tokens -= 1
+            site.retries += 1
+        RETRIES.inc(extractor=key, error_class=error_class)
+        return True
+
+    def record(self, key: str, error_class: Optional[str] = None, error: Any = None) -> None:
+        """Record the final outcome of a run admitted by `before_call` (`error_class` None on success)."""
+        now = time.monotonic()
+        with self._lock:
+            site = self._site(key)
+            site.trial_started = None
+            if error_class not in SITE_FAILURES:
+                site.last_success_at = now
+                site.consecutive_failures = 0
+                if site.state != CLOSED:
+                    site.cooldown = 0.0
+                    self._transition(key, site, CLOSED)
+                return
+
+            site.failures += 1
+            site.consecutive_failures += 1
+            site.last_error_class = error_class
+            site.last_error = str(error)[:200] if error else None
+            site.last_failure_at = now
+            if site.state == HALF_OPEN or (
+                site.state == CLOSED and site.consecutive_failures >= self.failure_threshold
+            ):
+                site.cooldown = min(self.max_cooldown, site.cooldown * 2 or self.base_cooldown)
+                site.open_until = now + site.cooldown
+                site.trips += 1
+                self._transition(key, site, OPEN)
+                self.logger.warning(
+                    f"{key} failed {site.consecutive_failures} times in a row ({error_class}); "
+                    f"pausing it for {site.cooldown:.0f}s"
+                )
+
+    def state(self, key: str) -> str:
+        with self._lock:
+            site = self._sites.get(key)
+            return site.state if site else CLOSED
+
+    def samples(self):
+        """(labels, value) pairs of circuit states for a metrics callback."""
+        with self._lock:
+            return [({'extractor': key}, STATE_VALUES[site.state]) for key, site in self._sites.items()]
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            sites = {
+                key: {
+                    'state': site.state,
+                    'retry_in': round(max(0.0, site.open_until - now), 1) if site.state == OPEN else 0.0,
+                    'consecutive_failures': site.consecutive_failures,
+                    'calls': site.calls,
+                    'failures': site.failures,
+                    'retries': site.retries,
+                    'rejected': site.rejected,
+                    'trips': site.trips,
+                    'last_error_class': site.last_error_class,
+                    'last_error': site.last_error,
+                    'last_failure_age': round(now - site.last_failure_at, 1) if site.last_failure_at else None,
+                    'last_success_age': round(now - site.last_success_at, 1) if site.last_success_at else None,
+                }
+                for key, site in self._sites.items()
+            }
+        return {
+            'open': sorted(key for key, site in sites.items() if site['state'] != CLOSED),
+            'sites': sites,
+        }
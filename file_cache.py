@@ -0,0 +1,269 @@
+import re
+import sqlite3
+import asyncio
+import threading
+import time
+import logging
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+# Query parameters that never change which media a link points to
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'igshid', 'igsh', 'gclid', 'ref', 'ref_src', 'pp', 'app'}
+
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalize a media URL so that different spellings of the same link share a cache key.
+
+    Known sites are reduced to "<extractor>:<video id>"; everything else keeps its
+    path with tracking parameters, fragments and "www."/"m." prefixes removed.
+    """
+    url = url.strip()
+    parts = urlsplit(url if '://' in url else f'https://{url}')
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip('/')
+    query = dict(parse_qsl(parts.query))
+
+    # YouTube: watch?v=ID, youtu.be/ID, /shorts/ID, /embed/ID, /live/ID
+    video_id = None
+    if host == 'youtu.be':
+        video_id = path.lstrip('/')
+    elif host.endswith('youtube.com'):
+        if path == '/watch':
+            video_id = query.get('v')
+        else:
+            segments = path.split('/')
+            if len(segments) >= 3 and segments[1] in ('shorts', 'embed', 'live', 'v'):
+                video_id = segments[2]
+    if video_id and YOUTUBE_ID_RE.match(video_id):
+        return f'youtube:{video_id}'
+
+    # Instagram: /p/ID, /reel/ID, /reels/ID, /tv/ID
+    if host.endswith('instagram.com'):
+        segments = path.split('/')
+        if len(segments) >= 3 and segments[1] in ('p', 'reel', 'reels', 'tv'):
+            return f'instagram:{segments[2]}'
+
+    kept = sorted(
+        (k, v) for k, v in query.items()
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    )
+    return urlunsplit(('https', host, path, urlencode(kept), ''))
+
+
+class FileIdCache:
+    """
+    Persistent cache of Telegram file_ids keyed by canonical URL and format.
+
+    A hit lets the bot resend media that was already uploaded once instead of
+    downloading and uploading it again. Entries expire after `ttl_seconds` and
+    the least recently used ones are evicted beyond `max_entries`.
+
+    Hits only note their recency in memory; it is written in one batch before
+    evicting (on `put`), once `recency_batch` entries are pending, and on close.
+    """
+
+    def __init__(self, db_path: str = 'file_cache.db', ttl_seconds: int = 7 * 24 * 3600,
+                 max_entries: int = 10000, recency_batch: int = 100):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.recency_batch = recency_batch
+        self.logger = logging.getLogger('FileIdCache')
+
+        self._lock = threading.Lock()
+        # (key, format) -> last hit time, not yet written
+        self._touched: Dict[tuple, float] = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            ' key TEXT NOT NULL,'
+            ' format TEXT NOT NULL,'
+            ' file_id TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' last_used REAL NOT NULL,'
+            ' PRIMARY KEY (key, format))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_file_ids_last_used ON file_ids (last_used)')
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # SQLite calls run on a worker thread so a slow disk never stalls the event loop
+
+    async def get(self, url: str, media_format: str) -> Optional[str]:
+        """Return the cached file_id for this URL/format, or None on a miss."""
+        return await asyncio.to_thread(self._get, url, media_format)
+
+    async def contains(self, url: str, media_format: str) -> bool:
+        """Check for a live entry without touching hit/miss counters or recency."""
+        return await asyncio.to_thread(self._contains, url, media_format)
+
+    async def put(self, url: str, media_format: str, file_id: str) -> None:
+        """Store the file_id Telegram returned after an upload."""
+        await asyncio.to_thread(self._put, url, media_format, file_id)
+
+    async def invalidate(self, url: str, media_format: str) -> None:
+        """Drop an entry, e.g. after Telegram rejected the stored file_id."""
+        await asyncio.to_thread(self._invalidate, url, media_format)
+
+    def _get(self, url: str, media_format: str) -> Optional[str]:
+        key = canonicalize_url(url)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT file_id, created_at FROM file_ids WHERE key = ? AND format = ?',
+                (key, media_format)
+            ).fetchone()
+            # Expired rows are deleted by the next eviction pass
+            if not row or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._touched[(key, media_format)] = now
+            if len(self._touched) >= self.recency_batch:
+                self._write_recency_locked()
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def _contains(self, url: str, media_format: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT created_at FROM file_ids WHERE key = ? AND format = ?',
+                (canonicalize_url(url), media_format)
+            ).fetchone()
+        return bool(row) and time.time() - row[0] <= self.ttl_seconds
+
+    def _put(self, url: str, media_format: str, file_id: str) -> None:
+        key = canonicalize_url(url)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO file_ids (key, format, file_id, created_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, media_format, file_id, now, now)
+            )
+            self._touched.pop((key, media_format), None)
+            self._write_recency_locked()
+            self._evict_locked(now)
+            self._conn.commit()
+
+    def _invalidate(self, url: str, media_format: str) -> None:
+        key = canonicalize_url(url)
+        with self._lock:
+            self._touched.pop((key, media_format), None)
+            self._conn.execute('DELETE FROM file_ids WHERE key = ? AND format = ?', (key, media_format))
+            self._conn.commit()
+            self.invalidations += 1
+        self.logger.info(f"Invalidated cached file_id for {key} ({media_format})")
+
+    def _write_recency_locked(self) -> None:
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE file_ids SET last_used = ? WHERE key = ? AND format = ?',
+                [(used, key, media_format) for (key, media_format), used in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _evict_locked(self, now: float) -> None:
+        expired = self._conn.execute(
+            'DELETE FROM file_ids WHERE created_at < ?', (now - self.ttl_seconds,)
+        ).rowcount
+        count = self._conn.execute('SELECT COUNT(*) FROM file_ids').fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                'DELETE FROM file_ids WHERE rowid IN '
+                '(SELECT rowid FROM file_ids ORDER BY last_used ASC LIMIT ?)',
+                (overflow,)
+            )
+        self.evictions += expired + max(overflow, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = self._conn.execute('SELECT COUNT(*) FROM file_ids').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_recency_locked()
+            self._conn.commit()
+            self._conn.close()
+
+
+class SharedFileIdCache:
+    """
+    FileIdCache with the same interface, stored in a shared StateBackend.
+
+    Used when workers run on several hosts so an upload made by one replica is
+    reused by all of them. Expiry uses the backend's key TTLs; size is bounded
+    by the backend's own eviction policy (e.g. Redis allkeys-lru).
+    """
+
+    def __init__(self, backend, ttl_seconds: int = 7 * 24 * 3600):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.logger = logging.getLogger('FileIdCache')
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _key(self, url: str, media_format: str) -> str:
+        return f'file_id:{media_format}:{canonicalize_url(url)}'
+
+    async def _call(self, func, *args, **kwargs):
+        # Backend calls are blocking network round trips
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def get(self, url: str, media_format: str) -> Optional[str]:
+        file_id = await self._call(self.backend.get, self._key(url, media_format))
+        if file_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return file_id
+
+    async def contains(self, url: str, media_format: str) -> bool:
+        return await self._call(self.backend.get, self._key(url, media_format)) is not None
+
+    async def put(self, url: str, media_format: str, file_id: str) -> None:
+        await self._call(self.backend.set, self._key(url, media_format), file_id, ttl=self.ttl_seconds)
+
+    async def invalidate(self, url: str, media_format: str) -> None:
+        await self._call(self.backend.delete, self._key(url, media_format))
+        self.invalidations += 1
+        self.logger.info(f"Invalidated cached file_id for {canonicalize_url(url)} ({media_format})")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,315 @@
+from typing import Dict, Any, List, Optional
+
+# Bitrate of the AAC produced when an audio source has to be re-encoded (see media_pipeline)
+AUDIO_TRANSCODE_KBPS = 128
+# Audio codecs Telegram plays as-is (yt-dlp reports e.g. 'mp4a.40.2')
+PASSTHROUGH_AUDIO_CODECS = ('mp4a', 'aac', 'mp3')
+
+# --- Size fitting ---
+# Share of the size limit a fitted file aims for (container overhead, bitrate overshoot)
+FIT_HEADROOM = 0.9
+# Below these bitrates a re-encode isn't worth watching/listening to; split instead
+FIT_MIN_VIDEO_KBPS = 200
+FIT_MIN_AUDIO_KBPS = 48
+FIT_VIDEO_AUDIO_KBPS = 64
+# Output height for a given video bitrate: (minimum kbps, height)
+FIT_HEIGHTS = ((1500, 720), (800, 480), (400, 360), (0, 240))
+
+
+def estimate_size(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[int]:
+    """Best guess of a format's size in bytes, or None if nothing is known."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+
+def _formats(info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Direct links have no format list; the info dict itself describes the only format
+    return info.get('formats') or [info]
+
+
+def _has_video(fmt: Dict[str, Any]) -> bool:
+    return fmt.get('vcodec') != 'none'
+
+
+def _has_audio(fmt: Dict[str, Any]) -> bool:
+    return fmt.get('acodec') != 'none'
+
+
+def _video_only(fmt: Dict[str, Any]) -> bool:
+    return bool(fmt.get('vcodec')) and _has_video(fmt) and fmt.get('acodec') == 'none'
+
+
+def _audio_only(fmt: Dict[str, Any]) -> bool:
+    return bool(fmt.get('acodec')) and _has_audio(fmt) and fmt.get('vcodec') == 'none'
+
+
+def _passthrough_audio(fmt: Dict[str, Any]) -> bool:
+    return (fmt.get('acodec') or '').split('.')[0] in PASSTHROUGH_AUDIO_CODECS
+
+
+def _passthrough_video(fmt: Dict[str, Any]) -> bool:
+    # Merged pseudo-formats are only built from H.264 streams
+    return '+' in fmt.get('format_id', '') or (fmt.get('vcodec') or '').startswith(('avc1', 'h264'))
+
+
+def _quality(fmt: Dict[str, Any]):
+    return (fmt.get('height') or 0, fmt.get('tbr') or 0)
+
+
+def _merged(video: Dict[str, Any], audio: Dict[str, Any], duration: Optional[float]) -> Dict[str, Any]:
+    """A pseudo-format for a separate video and audio stream that yt-dlp remuxes into one MP4."""
+    video_size, audio_size = estimate_size(video, duration), estimate_size(audio, duration)
+    return {
+        'format_id': f"{video['format_id']}+{audio['format_id']}",
+        'height': video.get('height'),
+        'tbr': (video.get('tbr') or 0) + (audio.get('tbr') or 0),
+        'filesize': video_size + audio_size if video_size and audio_size else None,
+    }
+
+
+def _best_fitting(candidates: List[Dict[str, Any]], duration: Optional[float], max_bytes: int):
+    """
+    Pick the highest quality candidate whose size fits, from a worst-to-best list.
+
+    Returns (format, size, error). Formats of unknown size are accepted; the
+    download's own size guard still applies to them.
+    """
+    if not candidates:
+        return None, None, 'No compatible format available'
+    for fmt in reversed(candidates):
+        size = estimate_size(fmt, duration)
+        if size is None or size <= max_bytes:
+            return fmt, size, None
+    smallest = min(estimate_size(fmt, duration) for fmt in candidates)
+    return None, smallest, (
+        f'File size ({smallest / 1024 / 1024:.2f}MB) exceeds limit ({max_bytes / 1024 / 1024:.2f}MB)'
+    )
+
+
+def _any_video_sources(info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Every downloadable video (progressive or video+audio pair), whatever the codec, worst to best."""
+    formats = _formats(info)
+    duration = info.get('duration')
+    sources = [fmt for fmt in formats if _has_video(fmt) and _has_audio(fmt) and fmt.get('format_id')]
+    audio = [fmt for fmt in formats if _audio_only(fmt)]
+    if audio:
+        smallest_audio = min(audio, key=lambda fmt: fmt.get('abr') or fmt.get('tbr') or 0)
+        sources += [_merged(fmt, smallest_audio, duration) for fmt in formats if _video_only(fmt)]
+    return sorted(sources, key=_quality)
+
+
+def plan_video_fit(info: Dict[str, Any], max_bytes: int, max_source_bytes: int, max_parts: int):
+    """
+    How to deliver a video no format of which fits in `max_bytes`.
+
+    Re-encodes to the bitrate the duration allows if that is still watchable,
+    otherwise downloads the best source that fits in `max_parts` parts and
+    splits it. Returns (plan, estimated size) or (None, None).
+    """
+    duration = info.get('duration')
+    if not duration:
+        return None, None
+    sources = [
+        (fmt, estimate_size(fmt, duration)) for fmt in _any_video_sources(info)
+    ]
+    sources = [(fmt, size) for fmt, size in sources if size and size <= max_source_bytes]
+    if not sources:
+        return None, None
+
+    video_kbps = max_bytes * FIT_HEADROOM * 8 / 1000 / duration - FIT_VIDEO_AUDIO_KBPS
+    if video_kbps >= FIT_MIN_VIDEO_KBPS:
+        height = next(height for kbps, height in FIT_HEIGHTS if video_kbps >= kbps)
+        # The smallest source that still has the output's resolution
+        source, size = next(
+            ((fmt, size) for fmt, size in sources if (fmt.get('height') or 0) >= height), sources[-1]
+        )
+        return {
+            'mode': 'bitrate', 'format_id': source['format_id'], 'source_size': size,
+            'height': height, 'video_kbps': int(video_kbps), 'audio_kbps': FIT_VIDEO_AUDIO_KBPS,
+        }, int(max_bytes * FIT_HEADROOM)
+
+    part_budget = max_bytes * FIT_HEADROOM
+    fitting = [(fmt, size) for fmt, size in sources if size <= part_budget * max_parts]
+    if not fitting:
+        return None, None
+    source, size = fitting[-1]
+    return {
+        'mode': 'split', 'format_id': source['format_id'], 'source_size': size,
+        'parts': -(-size // int(part_budget)),
+    }, size
+
+
+def plan_audio_fit(info: Dict[str, Any], max_bytes: int, max_source_bytes: int, max_parts: int):
+    """Audio counterpart of plan_video_fit."""
+    duration = info.get('duration')
+    if not duration:
+        return None, None
+    sources = [
+        (fmt, estimate_size(fmt, duration)) for fmt in _formats(info)
+        if _audio_only(fmt) and fmt.get('format_id')
+    ]
+    sources = sorted(
+        ((fmt, size) for fmt, size in sources if size and size <= max_source_bytes), key=lambda item: item[1]
+    )
+    if not sources:
+        return None, None
+
+    audio_kbps = int(max_bytes * FIT_HEADROOM * 8 / 1000 / duration)
+    if audio_kbps >= FIT_MIN_AUDIO_KBPS:
+        source, size = sources[0]
+        return {
+            'mode': 'bitrate', 'format_id': source['format_id'], 'source_size': size,
+            'audio_kbps': min(audio_kbps, AUDIO_TRANSCODE_KBPS),
+        }, int(max_bytes * FIT_HEADROOM)
+
+    part_budget = max_bytes * FIT_HEADROOM
+    fitting = [(fmt, size) for fmt, size in sources if size <= part_budget * max_parts]
+    if not fitting:
+        return None, None
+    source, size = fitting[-1]
+    return {
+        'mode': 'split', 'format_id': source['format_id'], 'source_size': size,
+        'parts': -(-size // int(part_budget)),
+    }, size
+
+
+def pick_video_format(info: Dict[str, Any], max_bytes: int, allow_merge: bool = True):
+    """
+    Best H.264 MP4 that fits in `max_bytes`.
+
+    Considers progressive MP4s and, when `allow_merge` is set (ffmpeg is
+    available), separate H.264 video + M4A audio streams that are merged
+    without re-encoding; sites often only offer their good qualities that way.
+    """
+    formats = _formats(info)
+    duration = info.get('duration')
+    candidates = [
+        fmt for fmt in formats
+        if fmt.get('ext') == 'mp4' and _has_video(fmt) and _has_audio(fmt)
+    ]
+    if allow_merge:
+        audio = [fmt for fmt in formats if _audio_only(fmt) and fmt.get('ext') == 'm4a']
+        if audio:
+            best_audio = max(audio, key=lambda fmt: fmt.get('abr') or fmt.get('tbr') or 0)
+            candidates += [
+                _merged(fmt, best_audio, duration) for fmt in formats
+                if _video_only(fmt) and fmt.get('ext') == 'mp4' and (fmt.get('vcodec') or '').startswith('avc1')
+            ]
+    candidates.sort(key=_quality)
+    return _best_fitting(candidates, duration, max_bytes)
+
+
+def pick_audio_format(info: Dict[str, Any], max_bytes: int):
+    """
+    Best audio source that fits in `max_bytes`, preferring codecs that are sent as-is.
+
+    AAC/MP3 streams are passed through untouched; anything else (e.g. Opus) is
+    re-encoded to AAC at AUDIO_TRANSCODE_KBPS, so its size is estimated from that.
+    """
+    duration = info.get('duration')
+    formats = _formats(info)
+    candidates = [fmt for fmt in formats if _has_audio(fmt) and not _has_video(fmt)]
+    if not candidates:
+        candidates = [fmt for fmt in formats if _has_audio(fmt)]
+
+    candidates.sort(key=lambda fmt: fmt.get('abr') or fmt.get('tbr') or 0)
+    passthrough = [fmt for fmt in candidates if _passthrough_audio(fmt)]
+    fmt, size, error = _best_fitting(passthrough, duration, max_bytes)
+    if fmt or not candidates:
+        return fmt, size, error
+
+    size = int(AUDIO_TRANSCODE_KBPS * 1000 / 8 * duration) if duration else None
+    if size and size > max_bytes:
+        return None, size, (
+            f'File size ({size / 1024 / 1024:.2f}MB) exceeds limit ({max_bytes / 1024 / 1024:.2f}MB)'
+        )
+    return candidates[-1], size, None
+
+
+def summarize_probe(info: Dict[str, Any], max_bytes: int, allow_merge: bool = True,
+                    fit_max_parts: int = 0, fit_max_source_bytes: int = 0) -> Dict[str, Any]:
+    """
+    Reduce an info dict to what the bot needs: identity, duration and the chosen formats.
+
+    With `fit_max_parts` set (ffmpeg available), a media type with no fitting
+    format gets a '{video,audio}_fit' plan instead of an error when possible.
+    Playlists have no formats of their own; their item URLs are in 'entries'.
+    """
+    if info.get('_type') == 'playlist':
+        return summarize_playlist(info)
+
+    video, video_size, video_error = pick_video_format(info, max_bytes, allow_merge=allow_merge)
+    audio, audio_size, audio_error = pick_audio_format(info, max_bytes)
+
+    fits = {'video': None, 'audio': None}
+    if fit_max_parts:
+        if video is None:
+            fits['video'], size = plan_video_fit(info, max_bytes, fit_max_source_bytes, fit_max_parts)
+            if fits['video']:
+                video, video_size, video_error = {'format_id': fits['video']['format_id']}, size, None
+        if audio is None:
+            fits['audio'], size = plan_audio_fit(info, max_bytes, fit_max_source_bytes, fit_max_parts)
+            if fits['audio']:
+                audio, audio_size, audio_error = {'format_id': fits['audio']['format_id']}, size, None
+
+    return {
+        'success': True,
+        'error': None,
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'id': info.get('id'),
+        'video_format': video.get('format_id') if video else None,
+        'video_size': video_size,
+        'video_error': video_error,
+        'audio_format': audio.get('format_id') if audio else None,
+        'audio_size': audio_size,
+        'audio_error': audio_error,
+        # Whether MediaPipeline will have to re-encode (not just remux) the chosen format
+        'video_transcode': bool(video) and (
+            not _passthrough_video(video) or (fits['video'] or {}).get('mode') == 'bitrate'
+        ),
+        'audio_transcode': bool(audio) and (
+            not _passthrough_audio(audio) or (fits['audio'] or {}).get('mode') == 'bitrate'
+        ),
+        'video_fit': fits['video'],
+        'audio_fit': fits['audio'],
+        'entries': None,
+        'info': info,
+    }
+
+
+def summarize_playlist(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Probe summary for a flat-extracted playlist: the URLs of its items instead of formats."""
+    entries = [
+        entry.get('webpage_url') or entry.get('url')
+        for entry in info.get('entries') or [] if entry
+    ]
+    # Some extractors list bare ids; only full URLs can be downloaded on their own
+    entries = [url for url in entries if url and url.startswith(('http://', 'https://'))]
+    error = 'Send the playlist link on its own to download its items' if entries else 'The playlist is empty'
+    return {
+        'success': True,
+        'error': None,
+        'title': info.get('title'),
+        'duration': None,
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'id': info.get('id'),
+        'video_format': None,
+        'video_size': None,
+        'video_error': error,
+        'audio_format': None,
+        'audio_size': None,
+        'audio_error': error,
+        'video_transcode': False,
+        'audio_transcode': False,
+        'video_fit': None,
+        'audio_fit': None,
+        'entries': entries,
+        'playlist_count': info.get('playlist_count') or len(entries),
+        'info': info,
+    }
@@ -0,0 +1,85 @@
+import json
+import time
+import asyncio
+import secrets
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Probe fields worth keeping with a link; the full info dict stays in the worker's probe cache
+PROBE_FIELDS = (
+    'success', 'error', 'title', 'duration', 'extractor',
+    'video_format', 'video_size', 'video_error', 'audio_format', 'audio_size', 'audio_error',
+    'entries', 'playlist_count',
+)
+
+
+class LinkRegistry:
+    """
+    Short ids for links waiting on a format choice, stored in the state backend.
+
+    Each incoming link gets its own id, carried in the buttons' callback_data
+    (e.g. `download_audio_<id>`), so every prompt a user has open keeps working
+    until `ttl` runs out and any worker can resolve it.
+    """
+
+    ID_BYTES = 6  # 8 URL-safe characters
+
+    def __init__(self, state, ttl: float = 24 * 3600):
+        self.state = state
+        self.ttl = ttl
+        self.logger = logging.getLogger('LinkRegistry')
+
+        self.registered = 0
+        self.resolved = 0
+        self.expired = 0
+
+    async def _call(self, func, *args):
+        if not self.state.shared:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def register(self, user_id: int, url: str) -> str:
+        """Store `url` and return the id to put in callback_data."""
+        return await self._store({'url': url, 'user_id': user_id, 'created': time.time()})
+
+    async def register_batch(self, user_id: int, urls, title: Optional[str] = None) -> str:
+        """Store several links (e.g. a playlist's items) to be downloaded together (`batch_<format>_<id>`)."""
+        return await self._store({'urls': list(urls), 'title': title, 'user_id': user_id, 'created': time.time()})
+
+    async def _store(self, data: Dict[str, Any]) -> str:
+        entry = json.dumps(data)
+        while True:
+            link_id = secrets.token_urlsafe(self.ID_BYTES)
+            if await self._call(self.state.set_if_absent, f"link:{link_id}", entry, self.ttl):
+                break
+        self.registered += 1
+        return link_id
+
+    async def get(self, link_id: str) -> Optional[Dict[str, Any]]:
+        """The stored entry ({'url' or 'urls', 'user_id', 'created'} and maybe 'probe'), or None once expired."""
+        raw = await self._call(self.state.get, f"link:{link_id}")
+        if raw is None:
+            self.expired += 1
+            return None
+        self.resolved += 1
+        return json.loads(raw)
+
+    async def attach_probe(self, link_id: str, probe: Dict[str, Any]) -> None:
+        """Remember what the prefetch found out about the link, for whichever worker gets the tap."""
+        raw = await self._call(self.state.get, f"link:{link_id}")
+        if raw is None:
+            return
+        entry = json.loads(raw)
+        entry['probe'] = {field: probe.get(field) for field in PROBE_FIELDS}
+        remaining = self.ttl - (time.time() - entry['created'])
+        if remaining > 0:
+            await self._call(self.state.set, f"link:{link_id}", json.dumps(entry), remaining)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'registered': self.registered,
+            'resolved': self.resolved,
+            'expired': self.expired,
+        }
@@ -1,15 +1,26 @@
 import os
+import sys
+import html
 import logging
-import shutil
+import time
+import uuid
+import tempfile
+import socket
 import asyncio 
-import json
-from datetime import datetime
-from typing import Dict, Any, Union
-from contextlib import asynccontextmanager
+from typing import Dict, Any, Union, Optional
+from contextlib import asynccontextmanager, ExitStack
+
+# uvicorn imports "main:app"; when this file is run as a script (or re-run in a
+# spawned worker) let that import find this module instead of executing the
+# file a second time with its own bot, queues and metrics
+if __name__ in ("__main__", "__mp_main__"):
+    sys.modules.setdefault('main', sys.modules[__name__])
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, MessageEntity
+)
 from telegram.ext import (
     ApplicationBuilder, 
     MessageHandler, 
@@ -17,12 +28,30 @@ from telegram.ext import (
     ContextTypes, 
     CommandHandler,
     Application,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    ChatMemberHandler
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
 # Import local DownloadManager (Assuming it takes max_file_size_bytes)
 from download_manager import DownloadManager 
+from file_cache import FileIdCache, SharedFileIdCache, canonicalize_url
+from singleflight import SingleFlight
+from analytics_store import AnalyticsStore, RedisAnalyticsStore
+from prefetch import Prefetcher
+from admin_feed import AdminFeed
+from ttl_cache import TTLCache
+from scheduler import DownloadScheduler, JobCancelled
+from storage import StorageManager
+from state_backend import create_backend
+from update_queue import UpdateQueue, QUEUED, FULL
+from link_registry import LinkRegistry
+from batch import BatchProgress, MEDIA_GROUP_SIZE, extract_urls, media_group
+from metrics import REGISTRY, STAGE_SECONDS
+from transport import create_request
+from progress import ProgressReporter
+from extractor_health import ExtractorHealth
 
 # --- Configuration ---
 PORT = int(os.environ.get('PORT', 5000)) 
@@ -30,12 +59,74 @@ BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '7817163480:AAE4Z1dBE_LK9gTN75x
 WEBHOOK_URL = os.environ.get('WEBHOOK_BASE_URL', 'https://ff-like-bot-px1w.onrender.com') 
 YOUTUBE_COOKIES = os.environ.get('YOUTUBE_COOKIES', '')
 FORCE_CHANNEL_ID = os.environ.get('FORCE_CHANNEL_ID', '') 
+# Bot API server; point it at a local Bot API server (or the benchmark stub) to bypass api.telegram.org
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# Bot API calls and file uploads use separate connection pools
+TELEGRAM_API_POOL_SIZE = int(os.environ.get('TELEGRAM_API_POOL_SIZE', 64))
+TELEGRAM_MEDIA_POOL_SIZE = int(os.environ.get('TELEGRAM_MEDIA_POOL_SIZE', 8))
+TELEGRAM_HTTP2 = os.environ.get('TELEGRAM_HTTP2', '1') == '1'  # Needs the h2 package
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.environ.get('TELEGRAM_KEEPALIVE_EXPIRY', 30))
+# Uploads may take UPLOAD_BASE_TIMEOUT plus one second per UPLOAD_MIN_RATE_KB of file
+UPLOAD_BASE_TIMEOUT = float(os.environ.get('UPLOAD_BASE_TIMEOUT', 30))
+UPLOAD_MIN_RATE = int(os.environ.get('UPLOAD_MIN_RATE_KB', 256)) * 1024
 
 WEBHOOK_PATH = f"/{BOT_TOKEN}" if BOT_TOKEN else "/webhook"
 PRIVACY_POLICY_PATH = "/privacy"
 MAX_FILE_SIZE_BYTES = 50 * 1024 * 1024 
 ADMIN_CHANNEL_ID = -1003479404949 
-ANALYTICS_FILE = "analytics.json"
+MEMBERSHIP_TTL_MEMBER = float(os.environ.get('MEMBERSHIP_TTL_MEMBER', 3600))
+MEMBERSHIP_TTL_NON_MEMBER = float(os.environ.get('MEMBERSHIP_TTL_NON_MEMBER', 60))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 100000))
+ADMIN_FEED_INTERVAL = float(os.environ.get('ADMIN_FEED_INTERVAL', 10))
+ADMIN_FEED_MAX_BATCH = int(os.environ.get('ADMIN_FEED_MAX_BATCH', 25))
+ANALYTICS_FILE = "analytics.json"  # Legacy store, imported into ANALYTICS_DB on first start
+ANALYTICS_DB = os.environ.get('ANALYTICS_DB', 'analytics.db')
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 5))
+DOWNLOAD_ENGINE = os.environ.get('DOWNLOAD_ENGINE', 'inprocess')  # 'inprocess' or 'subprocess'
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 2))
+PROBE_CACHE_TTL = float(os.environ.get('PROBE_CACHE_TTL', 600))
+PREFETCH_DOWNLOAD = os.environ.get('PREFETCH_DOWNLOAD', '0') == '1'
+PREFETCH_TTL = float(os.environ.get('PREFETCH_TTL', 300))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', DOWNLOAD_WORKERS))
+MAX_CONCURRENT_TRANSCODES = int(os.environ.get('MAX_CONCURRENT_TRANSCODES', 1))
+TRANSCODE_THREADS = int(os.environ.get('TRANSCODE_THREADS', 2))  # ffmpeg threads per re-encode
+# Oversized media is re-encoded to fit or split into up to FIT_MAX_PARTS parts (0 disables)
+FIT_MAX_PARTS = int(os.environ.get('FIT_MAX_PARTS', 4))
+FIT_MAX_SOURCE_BYTES = int(os.environ.get('FIT_MAX_SOURCE_MB', 500)) * 1024 * 1024
+WORK_DIR = os.environ.get('WORK_DIR', os.path.join(tempfile.gettempdir(), 'vidxpress'))
+DISK_BUDGET_BYTES = int(os.environ.get('DISK_BUDGET_MB', 2048)) * 1024 * 1024
+TMPFS_DIR = os.environ.get('TMPFS_DIR', '')  # e.g. /dev/shm for small audio jobs; empty disables
+TMPFS_BUDGET_BYTES = int(os.environ.get('TMPFS_BUDGET_MB', 256)) * 1024 * 1024
+ORPHAN_REAP_INTERVAL = float(os.environ.get('ORPHAN_REAP_INTERVAL', 600))
+MAX_JOBS_PER_USER = int(os.environ.get('MAX_JOBS_PER_USER', 1))
+# Messages with several links (or a playlist) are downloaded as one batch of up to BATCH_MAX_ITEMS
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 10))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 3))  # Items of a user's batches run at once
+# Minimum seconds between edits of a download's progress message (Telegram rate-limits edits)
+PROGRESS_EDIT_INTERVAL = float(os.environ.get('PROGRESS_EDIT_INTERVAL', 3))
+# Transient extractor errors (timeouts, 429, 5xx) are retried with jittered backoff
+EXTRACTOR_MAX_ATTEMPTS = int(os.environ.get('EXTRACTOR_MAX_ATTEMPTS', 3))
+EXTRACTOR_RETRY_BASE_DELAY = float(os.environ.get('EXTRACTOR_RETRY_BASE_DELAY', 1))
+EXTRACTOR_RETRY_MAX_DELAY = float(os.environ.get('EXTRACTOR_RETRY_MAX_DELAY', 10))
+# A site failing this many times in a row is skipped for a cooldown that doubles while it stays down
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN', 60))
+CIRCUIT_MAX_COOLDOWN = float(os.environ.get('CIRCUIT_MAX_COOLDOWN', 900))
+FILE_CACHE_DB = os.environ.get('FILE_CACHE_DB', 'file_cache.db')
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', 7 * 24 * 3600))
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get('FILE_CACHE_MAX_ENTRIES', 10000))
+# memory:// (single worker), sqlite:///state.db (workers on one host) or redis://host:6379/0 (replicas)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory://')
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+LINK_TTL = float(os.environ.get('LINK_TTL', 24 * 3600))  # How long format buttons keep working
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 600))
+REMOTE_JOB_POLL_INTERVAL = 2.0
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Optional; when set, Telegram must echo it in X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_DEDUPE_TTL = float(os.environ.get('UPDATE_DEDUPE_TTL', 3600))
 
 # Set up logging
 logging.basicConfig(
@@ -44,26 +135,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- Analytics Functions ---
+# --- Metrics ---
 
-def load_analytics():
-    if not os.path.exists(ANALYTICS_FILE):
-        return {"total_users": [], "total_requests": 0, "daily_usage": {}, "logs": []}
-    try:
-        with open(ANALYTICS_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {"total_users": [], "total_requests": 0, "daily_usage": {}, "logs": []}
+REQUESTS = REGISTRY.counter(
+    'vidxpress_requests_total', 'Format button taps by how they were served', labels=('media', 'outcome')
+)
+UPLOADED_BYTES = REGISTRY.counter(
+    'vidxpress_uploaded_bytes_total', 'Bytes uploaded to Telegram', labels=('media',)
+)
 
-def save_analytics(data):
-    try:
-        with open(ANALYTICS_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        logger.error(f"Failed to save analytics: {e}")
+# --- Shared State ---
+
+# Everything another worker must see (pending links, running jobs, uploads) lives here
+state = create_backend(STATE_BACKEND)
+
+async def state_call(func, *args):
+    """Call a state backend method, off the event loop when it does I/O."""
+    if not state.shared:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+# --- Analytics Functions ---
+
+if state.name == 'redis':
+    analytics = RedisAnalyticsStore(state, flush_interval=ANALYTICS_FLUSH_INTERVAL)
+else:
+    analytics = AnalyticsStore(ANALYTICS_DB, flush_interval=ANALYTICS_FLUSH_INTERVAL, legacy_json=ANALYTICS_FILE)
+admin_feed = AdminFeed(ADMIN_CHANNEL_ID, flush_interval=ADMIN_FEED_INTERVAL, max_batch=ADMIN_FEED_MAX_BATCH)
 
 async def update_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Updates analytics data and sends log to admin channel."""
+    """Records the action in the analytics store and queues a log for the admin channel."""
     if not update.effective_user:
         return
 
@@ -74,55 +175,43 @@ async def update_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     username = update.effective_user.username or "Unknown"
 
-    # 1. Update Local JSON
-    data = load_analytics()
-
-    if user_id not in data["total_users"]:
-        data["total_users"].append(user_id)
-
-    data["total_requests"] += 1
-    today = datetime.now().strftime("%Y-%m-%d")
-    data["daily_usage"][today] = data["daily_usage"].get(today, 0) + 1
-
-    log_entry = {
-        "user": user_id, "username": username, "text": text, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    data["logs"].append(log_entry)
-    data["logs"] = data["logs"][-50:] 
-    
-    save_analytics(data)
+    # 1. Buffer the event; the store flushes to SQLite in the background
+    analytics.record(user_id, username, text)
 
-    # 2. Send Log to Admin Channel
+    # 2. Queue the log for the admin channel digest (never blocks the handler)
     if ADMIN_CHANNEL_ID:
-        try:
-            log_message = (
-                f"📊 <b>New Activity</b>\n"
-                f"👤 <b>User:</b> <a href='tg://user?id={user_id}'>{username}</a> (`{user_id}`)\n"
-                f"💬 <b>Action:</b> {text}"
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_CHANNEL_ID,
-                text=log_message,
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            logger.warning(f"Admin log failed: {e}")
+        admin_feed.publish(user_id, username, text)
 
 # --- Helper: Force Join Check ---
 
-async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+membership_cache = TTLCache(max_entries=MEMBERSHIP_CACHE_SIZE, default_ttl=MEMBERSHIP_TTL_MEMBER)
+
+async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, use_cache: bool = True) -> bool:
     """Checks if the user is a member of the forced channel."""
     if not FORCE_CHANNEL_ID: return True
     user_id = update.effective_user.id
+
+    if use_cache:
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            return cached
     
     try:
         member = await context.bot.get_chat_member(chat_id=FORCE_CHANNEL_ID, user_id=user_id)
-        if member.status in ['left', 'kicked']: return False
-        return True
+        is_member = member.status not in ['left', 'kicked']
     except Exception as e:
         logger.error(f"Error checking membership for {FORCE_CHANNEL_ID}: {e}")
         return True
 
+    # Members rarely leave, but non-members are expected to join soon
+    membership_cache.set(user_id, is_member, ttl=MEMBERSHIP_TTL_MEMBER if is_member else MEMBERSHIP_TTL_NON_MEMBER)
+    return is_member
+
+def is_force_channel(chat) -> bool:
+    if str(chat.id) == FORCE_CHANNEL_ID:
+        return True
+    return bool(chat.username) and f"@{chat.username}".lower() == FORCE_CHANNEL_ID.lower()
+
 async def send_force_join_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sends a message asking the user to join the channel."""
     clean_id = FORCE_CHANNEL_ID.lstrip('@')
@@ -221,11 +310,54 @@ PRIVACY_POLICY_HTML = """
 class TelegramBot:
     def __init__(self, token: str, max_file_size: int):
         # FIX: Ensure DownloadManager is initialized with MAX_FILE_SIZE_BYTES
-        self.download_manager = DownloadManager(max_file_size) 
-        self.app = ApplicationBuilder().token(token).build()
+        self.download_manager = DownloadManager(
+            max_file_size, engine=DOWNLOAD_ENGINE, engine_workers=DOWNLOAD_WORKERS, probe_ttl=PROBE_CACHE_TTL,
+            transcode_workers=MAX_CONCURRENT_TRANSCODES, transcode_threads=TRANSCODE_THREADS,
+            fit_max_parts=FIT_MAX_PARTS, fit_max_source_bytes=FIT_MAX_SOURCE_BYTES,
+            playlist_max_items=BATCH_MAX_ITEMS,
+            health=ExtractorHealth(
+                failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN,
+                max_cooldown=CIRCUIT_MAX_COOLDOWN
+            ),
+            max_attempts=EXTRACTOR_MAX_ATTEMPTS, retry_base_delay=EXTRACTOR_RETRY_BASE_DELAY,
+            retry_max_delay=EXTRACTOR_RETRY_MAX_DELAY,
+            storage=StorageManager(
+                WORK_DIR, budget_bytes=DISK_BUDGET_BYTES,
+                tmpfs_root=TMPFS_DIR or None, tmpfs_budget_bytes=TMPFS_BUDGET_BYTES
+            )
+        )
+        self.scheduler = DownloadScheduler(
+            max_downloads=MAX_CONCURRENT_DOWNLOADS,
+            max_transcodes=MAX_CONCURRENT_TRANSCODES,
+            per_user_limit=MAX_JOBS_PER_USER
+        )
+        self.inflight = SingleFlight()
+        self.links = LinkRegistry(state, ttl=LINK_TTL)
+        self._background_tasks = set()
+        if state.name == 'redis':
+            # Replicas on other hosts can't see a local SQLite file
+            self.file_cache = SharedFileIdCache(state, ttl_seconds=FILE_CACHE_TTL)
+        else:
+            self.file_cache = FileIdCache(FILE_CACHE_DB, ttl_seconds=FILE_CACHE_TTL, max_entries=FILE_CACHE_MAX_ENTRIES)
+        self.prefetcher = Prefetcher(
+            self.scheduler, self.download_manager, file_cache=self.file_cache,
+            speculative_download=PREFETCH_DOWNLOAD, ttl=PREFETCH_TTL
+        )
+        self.transport = create_request(
+            api_pool_size=TELEGRAM_API_POOL_SIZE, media_pool_size=TELEGRAM_MEDIA_POOL_SIZE,
+            http2=TELEGRAM_HTTP2, keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+            upload_base_timeout=UPLOAD_BASE_TIMEOUT, upload_min_rate=UPLOAD_MIN_RATE
+        )
+        self.app = (
+            ApplicationBuilder().token(token)
+            .base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+            .request(self.transport)
+            .build()
+        )
         
         self.app.add_handler(CommandHandler("start", self.start))
         self.app.add_handler(CallbackQueryHandler(self.handle_callback)) 
+        self.app.add_handler(ChatMemberHandler(self.handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
         self.app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.handle_message))
         
         self.logger = logging.getLogger('TelegramBot')
@@ -254,108 +386,485 @@ class TelegramBot:
         await query.answer()
         
         if query.data == "check_subscription":
-            if await check_membership(update, context):
+            # The user says they just joined, so a cached "not a member" is stale
+            if await check_membership(update, context, use_cache=False):
                 await query.edit_message_text("✅ **Thanks for joining!**\n\nNow you can send me any video link to download.", parse_mode=ParseMode.MARKDOWN)
             else:
                 await query.answer("❌ You haven't joined yet!", show_alert=True)
         
-        # Handle format selection callbacks
+        # Handle format selection callbacks. Downloads run as background tasks so
+        # they don't hold an update worker through queueing, download and upload
         elif query.data.startswith("download_"):
-            await self.process_download(query.data, update, context)
+            self.run_in_background(self.process_download(query.data, update, context))
+
+        elif query.data.startswith("batch_"):
+            self.run_in_background(self.process_batch(query.data, update))
+
+    async def handle_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Keep the membership cache current from chat_member updates for the forced channel."""
+        change = update.chat_member
+        if not FORCE_CHANNEL_ID or not is_force_channel(change.chat):
+            return
+        is_member = change.new_chat_member.status not in ['left', 'kicked']
+        membership_cache.set(
+            change.new_chat_member.user.id, is_member,
+            ttl=MEMBERSHIP_TTL_MEMBER if is_member else MEMBERSHIP_TTL_NON_MEMBER
+        )
 
     async def process_download(self, callback_data: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Process the download request based on format selection."""
         try:
-            # Extract format and URL from callback data
-            # Format: download_{audio|video}_{message_id}
-            parts = callback_data.split('_')
+            # Extract format and link id from callback data
+            # Format: download_{audio|video}_{link_id} (the id itself may contain '_')
+            parts = callback_data.split('_', 2)
             if len(parts) < 3:
                 await update.callback_query.answer("Invalid request", show_alert=True)
                 return
             
             download_format = parts[1]  # 'audio' or 'video'
-            url = context.user_data.get('pending_url')
+            link = await self.links.get(parts[2])
             
-            if not url:
+            if not link:
                 await update.callback_query.answer("Link expired. Please send it again.", show_alert=True)
                 return
+            url = link['url']
+            started = time.monotonic()
             
-            # Edit the message to show processing status
+            # Serve repeat links straight from Telegram's storage
+            if await self.send_cached(url, download_format, update):
+                try:
+                    await update.callback_query.message.delete()
+                except:
+                    pass
+                self.record_request(download_format, 'cached', started)
+                return
+
+            # A playlist that was resolved by now is downloaded item by item
+            probe = link.get('probe')
+            if probe and probe.get('entries'):
+                await self.run_batch(
+                    update.effective_user.id, probe['entries'][:BATCH_MAX_ITEMS], download_format,
+                    update.callback_query.message, title=probe['title']
+                )
+                self.record_request(download_format, 'batch', started)
+                return
+
+            # The prefetch may already have found that this format can't be sent
+            if probe and probe['success'] and not probe[f'{download_format}_format']:
+                await self.show_download_error(update.callback_query.message, probe[f'{download_format}_error'])
+                self.record_request(download_format, 'rejected', started)
+                return
+
             processing_message = update.callback_query.message
+            user_id = update.effective_user.id
+            job_key = (canonicalize_url(url), download_format)
+            if self.inflight.owner_of(job_key) == user_id:
+                # The user asked for this again while their earlier request is in flight:
+                # replace it if it is still queued, otherwise let it deliver the file
+                if not self.scheduler.cancel(user_id, job_key):
+                    await processing_message.edit_text("⏳ Already downloading this for you; it will arrive with your earlier request.")
+                    self.record_request(download_format, 'duplicate', started)
+                    return
+
+            # Edit the message to show processing status
             await processing_message.edit_text("⏳ Processing your request...", parse_mode=ParseMode.HTML)
             
             try:
-                # Run blocking I/O in a separate thread
-                if download_format == "audio":
-                    download_result = await asyncio.to_thread(
-                        self.download_manager.download, url, audio_only=True
-                    )
-                else:  # video
-                    download_result = await asyncio.to_thread(
-                        self.download_manager.download, url, audio_only=False
-                    )
-                
-                temp_dir = download_result.get('temp_dir')
-                
-                if not download_result['success']:
-                    error = download_result['error']
-                    hint = ""
-                    if "Sign in" in str(error): 
-                        hint = "\n🛑 Login required (Cookies invalid)."
-                    await processing_message.edit_text(
-                        f"❌ Failed: {error}{hint}",
-                        parse_mode=ParseMode.HTML
-                    )
-                    return
-                
-                file_path = download_result['file_path']
-                
-                # Delete the processing message
-                try:
-                    await processing_message.delete()
-                except:
-                    pass
-                
-                if file_path and os.path.exists(file_path):
-                    if download_format == "audio":
-                        # Send as audio file
-                        await update.callback_query.message.reply_audio(
-                            audio=open(file_path, 'rb'),
-                            caption="🎵 Audio extracted via VidXpress",
-                            read_timeout=60,
-                            write_timeout=60
-                        )
+                # Identical requests already in flight share one download and upload
+                result, shared = await self.inflight.do(
+                    job_key,
+                    lambda: self.fetch_or_wait(url, download_format, update, processing_message),
+                    owner=user_id
+                )
+                if shared:
+                    if result.get('cancelled'):
+                        # The original requester withdrew; do the work ourselves
+                        result = await self.fetch_and_upload(url, download_format, update, processing_message)
+                    elif result['success']:
+                        try:
+                            await processing_message.delete()
+                        except:
+                            pass
+                        await self.send_file_id(processing_message, result['file_id'], download_format)
+                        self.record_request(download_format, 'coalesced', started)
+                        return
                     else:
-                        # Send as video file
-                        await update.callback_query.message.reply_video(
-                            video=open(file_path, 'rb'),
-                            caption="✅ Downloaded via VidXpress",
-                            read_timeout=60,
-                            write_timeout=60
-                        )
+                        await self.show_download_error(processing_message, result['error'])
+                if result.get('cancelled'):
+                    outcome = 'cancelled'
                 else:
-                    await update.callback_query.message.reply_text("❌ File missing after download.")
+                    outcome = 'downloaded' if result['success'] else 'failed'
+                self.record_request(download_format, outcome, started)
             
             except Exception as e:
                 self.logger.error(f"Download error: {e}")
+                self.record_request(download_format, 'error', started)
                 await processing_message.edit_text(
                     "❌ Error occurred during processing.",
                     parse_mode=ParseMode.HTML
                 )
-            finally:
-                if 'temp_dir' in locals() and temp_dir and os.path.exists(temp_dir):
-                    try:
-                        shutil.rmtree(temp_dir)
-                    except:
-                        pass
-                # Clear the stored URL
-                if 'pending_url' in context.user_data:
-                    del context.user_data['pending_url']
         
         except Exception as e:
             self.logger.error(f"Callback error: {e}")
             await update.callback_query.answer("An error occurred. Please try again.", show_alert=True)
 
+    async def fetch_or_wait(self, url: str, download_format: str, update: Update, processing_message) -> Dict[str, Any]:
+        """
+        Run `fetch_and_upload` unless another worker is already fetching the same link.
+
+        In that case wait for its lease to end and send the file_id it left in
+        the shared cache; if it failed or vanished, do the work here instead.
+        """
+        if not state.shared:
+            return await self.fetch_and_upload(url, download_format, update, processing_message)
+
+        job_key = f"job:{download_format}:{canonicalize_url(url)}"
+        if await state_call(state.set_if_absent, job_key, WORKER_ID, JOB_LEASE_SECONDS):
+            try:
+                return await self.fetch_and_upload(url, download_format, update, processing_message)
+            finally:
+                await state_call(state.delete, job_key)
+
+        self.logger.info(f"Waiting for another worker to finish {canonicalize_url(url)} ({download_format})")
+        deadline = time.monotonic() + JOB_LEASE_SECONDS
+        while time.monotonic() < deadline and await state_call(state.get, job_key):
+            await asyncio.sleep(REMOTE_JOB_POLL_INTERVAL)
+
+        file_id = await self.file_cache.get(url, download_format)
+        if not file_id:
+            return await self.fetch_and_upload(url, download_format, update, processing_message)
+        try:
+            await processing_message.delete()
+        except:
+            pass
+        await self.send_file_id(processing_message, file_id, download_format)
+        return {'success': True, 'error': None, 'file_id': file_id}
+
+    async def fetch_and_upload(self, url: str, download_format: str, update: Update, processing_message) -> Dict[str, Any]:
+        """
+        Download `url` through the scheduler and upload it to the requesting chat.
+
+        Returns a dict with 'success', 'error' and 'file_id' so that coalesced
+        requests can reuse the upload.
+        """
+        temp_dir = None
+        reporter = ProgressReporter(processing_message, asyncio.get_running_loop(), interval=PROGRESS_EDIT_INTERVAL)
+        try:
+            # Reuse the background resolution (and download, if one was speculated)
+            await self.prefetcher.claim_probe(url)
+            download_result = await self.prefetcher.claim_download(url, download_format)
+
+            # Otherwise queue the blocking download behind the global/per-user limits
+            audio_only = download_format == "audio"
+            try:
+                if download_result is None:
+                    download_result = await self.scheduler.submit(
+                        update.effective_user.id, (canonicalize_url(url), download_format),
+                        self.download_manager.download, url, audio_only=audio_only,
+                        needs_transcode=self.download_manager.needs_transcode(url, download_format),
+                        on_position=self.queue_position_updater(processing_message),
+                        on_progress=reporter.report
+                    )
+            except JobCancelled:
+                await reporter.close()
+                await processing_message.edit_text("🚫 Cancelled: you requested this link again.")
+                return {'success': False, 'error': 'Cancelled', 'file_id': None, 'cancelled': True}
+            
+            temp_dir = download_result.get('temp_dir')
+            
+            if not download_result['success']:
+                error = download_result['error']
+                await reporter.close()
+                await self.show_download_error(processing_message, error)
+                return {'success': False, 'error': error, 'file_id': None}
+            
+            file_path = download_result['file_path']
+            
+            if file_path and os.path.exists(file_path):
+                # Media split to fit the size limit is sent as consecutive parts
+                parts = download_result.get('parts') or [file_path]
+                file_ids = []
+                started = time.monotonic()
+                for index, part in enumerate(parts, start=1):
+                    reporter.report({'stage': 'uploading', 'part': index, 'parts': len(parts)})
+                    UPLOADED_BYTES.inc(os.path.getsize(part), media=download_format)
+                    with open(part, 'rb') as media_file:
+                        # Let the HTTP client stream the file from disk in chunks
+                        # instead of reading it all into memory first; the upload
+                        # pool's timeouts scale with the file size
+                        media = InputFile(media_file, read_file_handle=False)
+                        caption = self.media_caption(download_format, index, len(parts))
+                        if download_format == "audio":
+                            # Send as audio file
+                            sent = await processing_message.reply_audio(
+                                audio=media,
+                                caption=caption
+                            )
+                        else:
+                            # Send as video file
+                            sent = await processing_message.reply_video(
+                                video=media,
+                                caption=caption
+                            )
+                    file_ids.append(self.media_file_id(download_format, sent))
+                STAGE_SECONDS.observe(time.monotonic() - started, stage='upload')
+                file_id = await self.remember_file_ids(url, download_format, file_ids)
+
+                # Delete the processing message
+                await reporter.close()
+                try:
+                    await processing_message.delete()
+                except:
+                    pass
+                if file_id is None:
+                    return {'success': False, 'error': 'Upload returned no file', 'file_id': None}
+                return {'success': True, 'error': None, 'file_id': file_id}
+            
+            await reporter.close()
+            await processing_message.edit_text("❌ File missing after download.")
+            return {'success': False, 'error': 'File missing after download.', 'file_id': None}
+        finally:
+            await reporter.close()
+            self.download_manager.storage.release(temp_dir)
+
+    # --- Batches ---
+
+    async def process_batch(self, callback_data: str, update: Update) -> None:
+        """Download every link of a batch (callback data: batch_{audio|video}_{batch_id})."""
+        parts = callback_data.split('_', 2)
+        if len(parts) < 3:
+            await update.callback_query.answer("Invalid request", show_alert=True)
+            return
+        download_format = parts[1]
+        batch = await self.links.get(parts[2])
+        if not batch or not batch.get('urls'):
+            await update.callback_query.answer("Links expired. Please send them again.", show_alert=True)
+            return
+        started = time.monotonic()
+        try:
+            await self.run_batch(
+                update.effective_user.id, batch['urls'], download_format,
+                update.callback_query.message, title=batch.get('title')
+            )
+            self.record_request(download_format, 'batch', started)
+        except Exception as e:
+            self.logger.error(f"Batch error: {e}")
+            self.record_request(download_format, 'error', started)
+            await update.callback_query.message.edit_text("❌ Error occurred during processing.")
+
+    async def run_batch(self, user_id: int, urls, download_format: str, message, title: Optional[str] = None) -> None:
+        """
+        Fetch all `urls` in parallel and deliver them as media groups, in the order they finish.
+
+        Up to BATCH_CONCURRENCY items of the user's batches download at once.
+        `message` becomes the progress message, edited as items complete.
+        """
+        progress = BatchProgress(len(urls), title)
+        await self.edit_batch_progress(message, progress)
+        # Scheduler keys unique to this batch, so another batch of the same links can't supersede these
+        batch_id = uuid.uuid4().hex[:8]
+        tasks = [
+            asyncio.create_task(self.fetch_batch_item(user_id, url, download_format, batch_id)) for url in urls
+        ]
+        group = []
+        try:
+            for next_item in asyncio.as_completed(tasks):
+                item = await next_item
+                if item['error']:
+                    progress.fail(item['url'], item['error'])
+                else:
+                    # Keep an item's parts together in one group
+                    if self.group_size(group) + len(item['media']) > MEDIA_GROUP_SIZE:
+                        await self.send_batch_group(message, download_format, group, progress)
+                        group = []
+                    group.append(item)
+                if self.group_size(group) == MEDIA_GROUP_SIZE or progress.finished + len(group) == progress.total:
+                    await self.send_batch_group(message, download_format, group, progress)
+                    group = []
+                await self.edit_batch_progress(message, progress)
+        except BaseException:
+            # Don't leave fetched files behind when the batch fails midway
+            for task in tasks:
+                task.cancel()
+            for item in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(item, dict):
+                    self.download_manager.storage.release(item['temp_dir'])
+            raise
+
+    def group_size(self, items) -> int:
+        return sum(len(item['media']) for item in items)
+
+    async def fetch_batch_item(self, user_id: int, url: str, download_format: str, batch_id: str) -> Dict[str, Any]:
+        """
+        One link of a batch, as {'url', 'media', 'uploaded', 'temp_dir', 'error'}.
+
+        'media' holds cached file_ids, or paths of downloaded parts ('uploaded' False).
+        """
+        cached = await self.file_cache.get(url, download_format)
+        if cached:
+            return {'url': url, 'media': cached.split(), 'uploaded': True, 'temp_dir': None, 'error': None}
+
+        await self.prefetcher.claim_probe(url)
+        result = await self.prefetcher.claim_download(url, download_format)
+        try:
+            if result is None:
+                key = ('batch', batch_id, canonicalize_url(url), download_format)
+                download = asyncio.ensure_future(self.scheduler.submit(
+                    user_id, key, self.download_manager.download, url, audio_only=download_format == "audio",
+                    needs_transcode=self.download_manager.needs_transcode(url, download_format),
+                    user_limit=BATCH_CONCURRENCY
+                ))
+                try:
+                    result = await asyncio.shield(download)
+                except asyncio.CancelledError:
+                    # A download already running can't be stopped; drop what it fetches once it ends
+                    self.scheduler.cancel(user_id, key)
+                    download.add_done_callback(self.release_abandoned)
+                    raise
+        except JobCancelled:
+            return {'url': url, 'media': [], 'uploaded': False, 'temp_dir': None, 'error': 'Cancelled'}
+        except Exception as e:
+            return {'url': url, 'media': [], 'uploaded': False, 'temp_dir': None, 'error': str(e)}
+        if not result['success']:
+            self.download_manager.storage.release(result.get('temp_dir'))
+            return {'url': url, 'media': [], 'uploaded': False, 'temp_dir': None, 'error': result['error']}
+        return {
+            'url': url, 'media': result.get('parts') or [result['file_path']], 'uploaded': False,
+            'temp_dir': result['temp_dir'], 'error': None
+        }
+
+    def release_abandoned(self, download: asyncio.Future) -> None:
+        if not download.cancelled() and download.exception() is None:
+            self.download_manager.storage.release(download.result().get('temp_dir'))
+
+    async def send_batch_group(self, message, download_format: str, items, progress: BatchProgress) -> None:
+        """Send finished batch items as one media group (a lone file as a normal reply)."""
+        if not items:
+            return
+        try:
+            with ExitStack() as files:
+                # Cached file_ids, or open files to upload
+                contents = []
+                for item in items:
+                    for media in item['media']:
+                        if item['uploaded']:
+                            contents.append(media)
+                        else:
+                            UPLOADED_BYTES.inc(os.path.getsize(media), media=download_format)
+                            contents.append(files.enter_context(open(media, 'rb')))
+                caption = self.media_caption(download_format)
+                started = time.monotonic()
+                if len(contents) == 1:
+                    content = contents[0]
+                    if not isinstance(content, str):
+                        content = InputFile(content, read_file_handle=False)
+                    if download_format == "audio":
+                        sent = [await message.reply_audio(audio=content, caption=caption)]
+                    else:
+                        sent = [await message.reply_video(video=content, caption=caption)]
+                else:
+                    sent = await message.reply_media_group(media_group(download_format, contents, caption))
+                STAGE_SECONDS.observe(time.monotonic() - started, stage='upload')
+        except Exception as e:
+            self.logger.error(f"Batch upload failed: {e}")
+            for item in items:
+                progress.fail(item['url'], 'Upload failed')
+            return
+        finally:
+            for item in items:
+                self.download_manager.storage.release(item['temp_dir'])
+
+        # Messages come back in the order the media was given
+        sent = list(sent)
+        for item in items:
+            messages, sent = sent[:len(item['media'])], sent[len(item['media']):]
+            if not item['uploaded']:
+                await self.remember_file_ids(
+                    item['url'], download_format, [self.media_file_id(download_format, msg) for msg in messages]
+                )
+            progress.sent += 1
+
+    async def edit_batch_progress(self, message, progress: BatchProgress) -> None:
+        try:
+            await message.edit_text(progress.render(), parse_mode=ParseMode.HTML)
+        except Exception as e:
+            self.logger.debug(f"Batch progress update failed: {e}")
+
+    def record_request(self, download_format: str, outcome: str, started: float) -> None:
+        REQUESTS.inc(media=download_format, outcome=outcome)
+        STAGE_SECONDS.observe(time.monotonic() - started, stage='request')
+
+    async def show_download_error(self, processing_message, error) -> None:
+        hint = ""
+        if "Sign in" in str(error): 
+            hint = "\n🛑 Login required (Cookies invalid)."
+        await processing_message.edit_text(
+            f"❌ Failed: {error}{hint}",
+            parse_mode=ParseMode.HTML
+        )
+
+    def queue_position_updater(self, message):
+        """Build a scheduler callback that shows the job's queue position in `message`."""
+        shown = {'position': 0}
+
+        async def update_position(position: int) -> None:
+            if position == shown['position']:
+                return
+            shown['position'] = position
+            if position == 0:
+                # The job started; its progress reports take over the message
+                return
+            text = f"⏳ Processing your request...\n\n📋 Position in queue: <b>{position}</b>"
+            await message.edit_text(text, parse_mode=ParseMode.HTML)
+
+        return update_position
+
+    def media_caption(self, download_format: str, part: int = 1, parts: int = 1) -> str:
+        caption = "🎵 Audio extracted via VidXpress" if download_format == "audio" else "✅ Downloaded via VidXpress"
+        if parts > 1:
+            caption += f" (part {part}/{parts})"
+        return caption
+
+    async def send_file_id(self, message, file_id: str, download_format: str) -> None:
+        """Reply to `message` with media Telegram already stores (space-separated ids for split media)."""
+        file_ids = file_id.split()
+        for index, part_id in enumerate(file_ids, start=1):
+            caption = self.media_caption(download_format, index, len(file_ids))
+            if download_format == "audio":
+                await message.reply_audio(audio=part_id, caption=caption)
+            else:
+                await message.reply_video(video=part_id, caption=caption)
+
+    async def send_cached(self, url: str, download_format: str, update: Update) -> bool:
+        """Resend previously uploaded media by file_id. Returns True on a cache hit."""
+        file_id = await self.file_cache.get(url, download_format)
+        if not file_id:
+            return False
+        try:
+            await self.send_file_id(update.callback_query.message, file_id, download_format)
+            return True
+        except BadRequest as e:
+            # Telegram no longer accepts this file_id; fall back to a fresh download
+            self.logger.warning(f"Cached file_id rejected: {e}")
+            await self.file_cache.invalidate(url, download_format)
+            return False
+
+    def media_file_id(self, download_format: str, sent) -> Optional[str]:
+        """The file_id of the media in an uploaded message."""
+        if download_format == "audio":
+            media = sent.audio or sent.document or sent.voice
+        else:
+            media = sent.video or sent.document or sent.animation
+        return media.file_id if media else None
+
+    async def remember_file_ids(self, url: str, download_format: str, file_ids) -> Optional[str]:
+        """Store the file_id(s) of an upload so repeat requests skip the download."""
+        if not file_ids or None in file_ids:
+            return None
+        file_id = " ".join(file_ids)
+        await self.file_cache.put(url, download_format, file_id)
+        return file_id
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # 1. Check Subscription First
         if not await check_membership(update, context):
@@ -364,38 +873,225 @@ class TelegramBot:
 
         await update_analytics(update, context)
         
-        url = update.message.text
-        if not url:
+        text = update.message.text
+        if not text:
+            return
+        linked = update.message.parse_entities([MessageEntity.TEXT_LINK])
+        urls = extract_urls(text, [entity.url for entity in linked], limit=BATCH_MAX_ITEMS)
+        if len(urls) > 1:
+            await self.prompt_batch(update, urls)
             return
+        # A bare link, or whatever the user typed for yt-dlp to make sense of
+        url = urls[0] if urls else text
 
-        # Store URL in user_data for later use in callback
-        context.user_data['pending_url'] = url
+        # Give the link its own id so every prompt the user has open stays usable
+        link_id = await self.links.register(update.effective_user.id, url)
+
+        # Resolve the link in the background while the user chooses
+        prefetch = self.prefetcher.prefetch(update.effective_user.id, url)
         
         # Create inline buttons for format selection
         keyboard = [
             [
-                InlineKeyboardButton("🎵 Audio Only", callback_data="download_audio_0"),
-                InlineKeyboardButton("🎬 Video", callback_data="download_video_0")
+                InlineKeyboardButton("🎵 Audio Only", callback_data=f"download_audio_{link_id}"),
+                InlineKeyboardButton("🎬 Video", callback_data=f"download_video_{link_id}")
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         # Send message with format selection buttons
-        await update.message.reply_text(
-            "📥 **Choose download format:**\n\n"
+        prompt = await update.message.reply_text(
+            "📥 <b>Choose download format:</b>\n\n"
             "🎵 Audio Only - Extract just the audio\n"
             "🎬 Video - Download the full video",
-            parse_mode=ParseMode.MARKDOWN,
+            parse_mode=ParseMode.HTML,
             reply_markup=reply_markup
         )
+        self.run_in_background(self.refine_prompt(prompt, update.effective_user.id, url, link_id, prefetch))
+
+    async def prompt_batch(self, update: Update, urls) -> None:
+        """Offer one format choice for all links in a message."""
+        user_id = update.effective_user.id
+        batch_id = await self.links.register_batch(user_id, urls)
+        for url in urls:
+            self.prefetcher.prefetch(user_id, url)
+        await update.message.reply_text(
+            self.batch_prompt_text(len(urls)), parse_mode=ParseMode.HTML,
+            reply_markup=self.batch_keyboard(batch_id, len(urls))
+        )
+
+    def batch_prompt_text(self, count: int, title: Optional[str] = None, playlist_count: Optional[int] = None) -> str:
+        if title:
+            header = f"📃 <b>{html.escape(title)}</b>"
+            if playlist_count and playlist_count > count:
+                header += f"\n(first {count} of {playlist_count} items)"
+        else:
+            header = f"📦 <b>{count} links</b>"
+        return f"{header}\n\n📥 <b>Choose a format for all of them:</b>"
+
+    def batch_keyboard(self, batch_id: str, count: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(f"🎵 Audio ({count})", callback_data=f"batch_audio_{batch_id}"),
+            InlineKeyboardButton(f"🎬 Video ({count})", callback_data=f"batch_video_{batch_id}")
+        ]])
+
+    def run_in_background(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def stop_background(self) -> None:
+        for task in list(self._background_tasks):
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    async def refine_prompt(self, prompt, user_id: int, url: str, link_id: str, prefetch: asyncio.Task) -> None:
+        """Once the prefetch resolves, show the title and sizes and drop formats that can't be sent."""
+        try:
+            probe = await prefetch
+        except Exception:
+            return
+        if probe:
+            await self.links.attach_probe(link_id, probe)
+        # Leave the message alone if the user already picked a format
+        if not probe or self.prefetcher.is_claimed(url):
+            return
+        try:
+            if not probe['success']:
+                await self.show_download_error(prompt, probe['error'])
+                return
+            if probe.get('entries'):
+                # A playlist: offer its first items as a batch
+                entries = probe['entries'][:BATCH_MAX_ITEMS]
+                batch_id = await self.links.register_batch(user_id, entries, title=probe['title'])
+                await prompt.edit_text(
+                    self.batch_prompt_text(len(entries), probe['title'] or 'Playlist', probe.get('playlist_count')),
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=self.batch_keyboard(batch_id, len(entries))
+                )
+                return
+            if not probe['video_format'] and not probe['audio_format']:
+                await self.show_download_error(prompt, probe['video_error'])
+                return
+
+            buttons = []
+            if probe['audio_format']:
+                buttons.append(InlineKeyboardButton("🎵 Audio Only", callback_data=f"download_audio_{link_id}"))
+            if probe['video_format']:
+                buttons.append(InlineKeyboardButton("🎬 Video", callback_data=f"download_video_{link_id}"))
+            await prompt.edit_text(
+                self.format_prompt(probe),
+                parse_mode=ParseMode.HTML,
+                reply_markup=InlineKeyboardMarkup([buttons])
+            )
+        except Exception as e:
+            self.logger.debug(f"Could not refine format prompt: {e}")
+
+    def format_prompt(self, probe: Dict[str, Any]) -> str:
+        """Describe the probed media and the available download formats."""
+        lines = ["📥 <b>Choose download format:</b>\n"]
+        if probe.get('title'):
+            lines.insert(0, f"🎞 <b>{html.escape(probe['title'])}</b>")
+        for media, label in (('audio', "🎵 Audio Only - Extract just the audio"),
+                             ('video', "🎬 Video - Download the full video")):
+            if probe[f'{media}_format']:
+                size = probe[f'{media}_size']
+                fit = probe.get(f'{media}_fit')
+                if fit and fit['mode'] == 'split':
+                    lines.append(f"{label} (~{size / 1024 / 1024:.1f}MB in {fit['parts']} parts)")
+                elif fit:
+                    lines.append(f"{label} (~{size / 1024 / 1024:.1f}MB, reduced quality)")
+                else:
+                    lines.append(f"{label} (~{size / 1024 / 1024:.1f}MB)" if size else label)
+            else:
+                lines.append(f"🚫 {media.capitalize()} unavailable: {html.escape(probe[f'{media}_error'])}")
+        return "\n".join(lines)
 
 # --- FastAPI & Lifespan ---
 
 application = None 
+bot_instance = None
+
+async def process_update(data: Dict[str, Any]):
+    await application.process_update(Update.de_json(data, application.bot))
+
+update_queue = UpdateQueue(
+    process_update, workers=UPDATE_WORKERS, max_size=UPDATE_QUEUE_SIZE, dedupe_ttl=UPDATE_DEDUPE_TTL, state=state
+)
+
+# Read at scrape time from the stats components already keep
+def _bot_gauge(read):
+    return lambda: read(bot_instance) if bot_instance else []
+
+def _cache_stats(bot):
+    return {
+        'file_id': bot.file_cache.stats(),
+        'probe': bot.download_manager.probe_cache.stats(),
+        'membership': membership_cache.stats(),
+    }
+
+def _storage_samples(bot):
+    stats = bot.download_manager.storage.stats()
+    return [({'kind': kind}, stats[f'{kind}_bytes']) for kind in ('used', 'reserved', 'tmpfs_reserved', 'free')]
+
+REGISTRY.callback(
+    'vidxpress_queue_depth', 'Jobs waiting per queue',
+    _bot_gauge(lambda bot: [
+        ({'queue': 'download'}, bot.scheduler.queue_depth),
+        ({'queue': 'background'}, bot.scheduler.stats()['background_queue_depth']),
+        ({'queue': 'transcode'}, bot.download_manager.pipeline.stats()['transcodes_waiting']),
+    ])
+)
+REGISTRY.callback('vidxpress_updates_queued', 'Telegram updates waiting for a handler', lambda: update_queue.stats()['queue_depth'])
+REGISTRY.callback(
+    'vidxpress_downloads_running', 'Download jobs running in the scheduler',
+    _bot_gauge(lambda bot: bot.scheduler.stats()['running'])
+)
+REGISTRY.callback(
+    'vidxpress_ytdlp_active', 'yt-dlp probes and downloads in progress',
+    _bot_gauge(lambda bot: bot.download_manager.active)
+)
+REGISTRY.callback(
+    'vidxpress_cache_hits_total', 'Cache hits per cache',
+    _bot_gauge(lambda bot: [({'cache': name}, stats['hits']) for name, stats in _cache_stats(bot).items()]),
+    kind='counter'
+)
+REGISTRY.callback(
+    'vidxpress_cache_misses_total', 'Cache misses per cache',
+    _bot_gauge(lambda bot: [({'cache': name}, stats['misses']) for name, stats in _cache_stats(bot).items()]),
+    kind='counter'
+)
+REGISTRY.callback(
+    'vidxpress_storage_bytes', 'Work directory usage',
+    _bot_gauge(_storage_samples)
+)
+REGISTRY.callback(
+    'vidxpress_extractor_circuit_state', 'Circuit breaker state per extractor (0 closed, 1 half-open, 2 open)',
+    _bot_gauge(lambda bot: bot.download_manager.health.samples())
+)
+REGISTRY.callback(
+    'vidxpress_bot_api_in_flight', 'Bot API requests in flight per connection pool',
+    _bot_gauge(lambda bot: [
+        ({'pool': pool.name}, pool.in_flight) for pool in (bot.transport.api, bot.transport.media)
+    ])
+)
+REGISTRY.callback(
+    'vidxpress_bot_api_pool_size', 'Connections allowed per Bot API pool',
+    _bot_gauge(lambda bot: [
+        ({'pool': pool.name}, pool.pool_size) for pool in (bot.transport.api, bot.transport.media)
+    ])
+)
+REGISTRY.register_histogram(
+    'vidxpress_update_queue_wait_seconds', 'Time updates wait for a handler', update_queue.queue_wait
+)
+REGISTRY.register_histogram(
+    'vidxpress_update_handling_seconds', 'Time spent handling an update', update_queue.handling_time
+)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global application
+    global application, bot_instance
+    await analytics.start()
     if BOT_TOKEN:
         logger.info("Initializing Bot...")
         # FIX: Pass max_file_size correctly to TelegramBot
@@ -403,19 +1099,42 @@ async def lifespan(app: FastAPI):
         application = bot_instance.app
         await application.initialize()
         await application.start()
+        await update_queue.start()
+        await bot_instance.download_manager.storage.start(ORPHAN_REAP_INTERVAL)
+        if ADMIN_CHANNEL_ID:
+            await admin_feed.start(application.bot)
         
-        if WEBHOOK_URL:
+        # With several workers only the first one to start registers the webhook
+        if WEBHOOK_URL and await state_call(state.set_if_absent, 'webhook:registered', WORKER_ID, 60):
             url = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
             logger.info(f"Setting webhook: {url}")
             try:
-                await application.bot.set_webhook(url=url, drop_pending_updates=True)
+                # Only the update types we handle; chat_member is opt-in and keeps the
+                # membership cache fresh. Anything else would take queue slots for nothing
+                await application.bot.set_webhook(
+                    url=url, drop_pending_updates=True,
+                    allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER],
+                    secret_token=WEBHOOK_SECRET or None
+                )
             except Exception as e:
                 logger.error(f"Webhook Set Failed: {e}")
     
     yield
     
+    await update_queue.stop()
+    if bot_instance:
+        await bot_instance.stop_background()
+    await admin_feed.stop()
     if application:
         await application.stop()
+    if bot_instance:
+        await bot_instance.prefetcher.stop()
+        await bot_instance.download_manager.storage.stop()
+        bot_instance.file_cache.close()
+        bot_instance.scheduler.shutdown()
+        bot_instance.download_manager.shutdown()
+    await analytics.stop()
+    state.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -423,18 +1142,51 @@ app = FastAPI(lifespan=lifespan)
 async def telegram_webhook(request: Request):
     if not application:
         return {"status": "error", "message": "Bot not initialized"}
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return JSONResponse({"status": "forbidden"}, status_code=403)
     try:
         data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.process_update(update)
-        return {"status": "ok"}
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return {"status": "error"}
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        return {"status": "ignored"}
+
+    # Acknowledge right away; handlers run on the update queue's workers
+    result = await update_queue.submit(data)
+    if result == FULL:
+        # A non-2xx makes Telegram redeliver the update later
+        return JSONResponse({"status": "busy"}, status_code=503, headers={"Retry-After": "1"})
+    return {"status": "ok" if result == QUEUED else result}
 
 @app.get("/")
 async def root():
-    return {"status": "active", "mode": "WEBHOOK"}
+    status = {"status": "active", "mode": "WEBHOOK"}
+    status["updates"] = update_queue.stats()
+    if bot_instance:
+        # The SQLite cache counts its rows; keep that off the event loop
+        status["file_cache"] = await asyncio.to_thread(bot_instance.file_cache.stats)
+        status["scheduler"] = bot_instance.scheduler.stats()
+        status["coalescing"] = bot_instance.inflight.stats()
+        status["links"] = bot_instance.links.stats()
+        status["probe_cache"] = bot_instance.download_manager.probe_cache.stats()
+        status["media_pipeline"] = bot_instance.download_manager.pipeline.stats()
+        status["storage"] = bot_instance.download_manager.storage.stats()
+        status["extractors"] = bot_instance.download_manager.health.stats()
+        status["prefetch"] = bot_instance.prefetcher.stats()
+        status["transport"] = bot_instance.transport.stats()
+    status["analytics"] = await asyncio.to_thread(analytics.summary)
+    status["admin_feed"] = admin_feed.stats()
+    status["membership_cache"] = membership_cache.stats()
+    status["state_backend"] = state.name
+    status["worker"] = WORKER_ID
+    return status
+
+@app.get("/metrics")
+async def metrics():
+    # Callbacks stat the work directories, so render off the event loop
+    body = await asyncio.to_thread(REGISTRY.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 @app.get(PRIVACY_POLICY_PATH)
 async def privacy():
@@ -442,4 +1194,6 @@ async def privacy():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=PORT)
+    if WEB_CONCURRENCY > 1 and not state.shared:
+        logger.warning("WEB_CONCURRENCY > 1 with the memory:// state backend; buttons will break across workers")
+    uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WEB_CONCURRENCY)
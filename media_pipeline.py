@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any
+
+from format_selection import AUDIO_TRANSCODE_KBPS, FIT_HEADROOM
+
+logger = logging.getLogger(__name__)
+
+# What Telegram plays inline: H.264 video with AAC/MP3 audio in MP4, and AAC (M4A) or MP3 audio
+VIDEO_CODECS = ('h264',)
+VIDEO_AUDIO_CODECS = ('aac', 'mp3')
+AUDIO_CONTAINERS = {'aac': 'm4a', 'mp3': 'mp3'}
+
+KEEP = 'keep'
+REMUX = 'remux'
+TRANSCODE = 'transcode'
+
+# Attempts at splitting with shorter segments when keyframe placement makes a part too large
+SPLIT_ATTEMPTS = 3
+
+
+def probe_streams(path: str) -> Dict[str, Any]:
+    """Container and first video/audio codec of a local file, via ffprobe."""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+        check=True, capture_output=True
+    )
+    data = json.loads(result.stdout)
+    streams = {
+        'container': data.get('format', {}).get('format_name', ''),
+        'duration': float(data.get('format', {}).get('duration') or 0),
+        'video': None,
+        'audio': None,
+    }
+    for stream in data.get('streams', []):
+        kind = stream.get('codec_type')
+        # Cover art shows up as a video stream in audio files
+        if kind == 'video' and stream.get('disposition', {}).get('attached_pic'):
+            continue
+        if kind in ('video', 'audio') and streams[kind] is None:
+            streams[kind] = stream.get('codec_name')
+    return streams
+
+
+def plan(path: str, streams: Dict[str, Any], media: str):
+    """
+    Decide how to make `path` sendable: (action, extension of the result).
+
+    Stream copy is used whenever the codecs are already playable and only the
+    container is wrong; re-encoding only when a codec itself is not.
+    """
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if media == 'audio':
+        target = AUDIO_CONTAINERS.get(streams['audio'])
+        if target is None:
+            return TRANSCODE, 'm4a'
+        return (KEEP if ext == target and streams['video'] is None else REMUX), target
+
+    if streams['video'] not in VIDEO_CODECS or streams['audio'] not in VIDEO_AUDIO_CODECS + (None,):
+        return TRANSCODE, 'mp4'
+    return (KEEP if ext == 'mp4' else REMUX), 'mp4'
+
+
+def ffmpeg_command(src: str, dst: str, action: str, media: str, streams: Dict[str, Any], threads: int):
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', src]
+    if media == 'audio':
+        cmd += ['-map', '0:a:0', '-vn']
+        if action == REMUX:
+            cmd += ['-c:a', 'copy']
+        else:
+            cmd += ['-threads', str(threads), '-c:a', 'aac', '-b:a', f'{AUDIO_TRANSCODE_KBPS}k']
+        return cmd + [dst]
+
+    cmd += ['-map', '0:v:0', '-map', '0:a:0?']
+    if action == REMUX:
+        cmd += ['-c', 'copy']
+    else:
+        cmd += ['-threads', str(threads), '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+                '-pix_fmt', 'yuv420p']
+        # Keep a playable audio track as-is even when the video must be re-encoded
+        if streams['audio'] in VIDEO_AUDIO_CODECS:
+            cmd += ['-c:a', 'copy']
+        else:
+            cmd += ['-c:a', 'aac', '-b:a', f'{AUDIO_TRANSCODE_KBPS}k']
+    # Put the index first so Telegram can start playback before the upload is read fully
+    return cmd + ['-movflags', '+faststart', dst]
+
+
+def fit_command(src: str, dst: str, media: str, fit: Dict[str, Any], threads: int):
+    """Re-encode to the bitrates (and, for video, the height) of a 'bitrate' fit plan."""
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', src, '-threads', str(threads)]
+    if media == 'audio':
+        return cmd + ['-map', '0:a:0', '-vn', '-c:a', 'aac', '-b:a', f"{fit['audio_kbps']}k", dst]
+    kbps = fit['video_kbps']
+    return cmd + [
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f"scale=-2:'min({fit['height']},ih)'",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-b:v', f'{kbps}k', '-maxrate', f'{int(kbps * 1.2)}k', '-bufsize', f'{kbps * 2}k',
+        '-c:a', 'aac', '-b:a', f"{fit['audio_kbps']}k",
+        '-movflags', '+faststart', dst
+    ]
+
+
+def split_command(src: str, pattern: str, segment_seconds: float):
+    """Cut `src` into parts of about `segment_seconds` by stream copy (cuts land on keyframes)."""
+    return [
+        'ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', src, '-map', '0', '-c', 'copy',
+        '-f', 'segment', '-segment_time', f'{segment_seconds:.2f}', '-reset_timestamps', '1',
+        '-segment_format_options', 'movflags=+faststart', pattern
+    ]
+
+
+def run_ffmpeg(cmd, nice: int = 0) -> float:
+    """Run ffmpeg to completion and return the CPU seconds (user + system) it used."""
+    if nice:
+        # nice execs ffmpeg in place, so the pid (and its rusage) stays the same
+        cmd = ['nice', '-n', str(nice), *cmd]
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        stderr = process.stderr.read()
+    finally:
+        process.stderr.close()
+    # wait4 reaps the child and reports its resource usage in one call
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+    return usage.ru_utime + usage.ru_stime
+
+
+class MediaPipeline:
+    """
+    Post-processing between the download and the upload.
+
+    Files Telegram can play are sent untouched, files in the wrong container
+    are remuxed (stream copy, cheap), and only incompatible codecs are
+    re-encoded. Re-encodes run on a pool of at most `max_transcodes` ffmpeg
+    processes, each limited to `threads` threads at `nice` priority, so the
+    webhook and downloads keep CPU headroom. CPU time is recorded per job.
+    """
+
+    def __init__(self, max_transcodes: int = 1, threads: int = 2, nice: int = 10):
+        self.max_transcodes = max_transcodes
+        self.threads = threads
+        self.nice = nice
+        self.logger = logging.getLogger('MediaPipeline')
+        self.available = shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+        if not self.available:
+            self.logger.warning("ffmpeg/ffprobe not found; downloads are sent without post-processing")
+
+        self._transcode_pool = ThreadPoolExecutor(max_workers=max_transcodes, thread_name_prefix='transcode')
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self.counts = {KEEP: 0, REMUX: 0, TRANSCODE: 0}
+        self.fitted = 0
+        self.split = 0
+        self.cpu_seconds = {REMUX: 0.0, TRANSCODE: 0.0}
+        self.failures = 0
+
+    def process(self, path: str, media: str) -> Dict[str, Any]:
+        """
+        Make `path` sendable as `media` ('audio' or 'video').
+
+        Returns {'file_path', 'action', 'cpu_seconds'}; the source file is
+        removed once a converted copy has been written.
+        """
+        if not self.available:
+            return {'file_path': path, 'action': KEEP, 'cpu_seconds': 0.0}
+
+        streams = probe_streams(path)
+        action, ext = plan(path, streams, media)
+        if action == KEEP:
+            self._record(KEEP, 0.0)
+            return {'file_path': path, 'action': KEEP, 'cpu_seconds': 0.0}
+
+        base, _ = os.path.splitext(path)
+        dst = f'{base}.{ext}'
+        if dst == path:
+            dst = f'{base}.out.{ext}'
+        cmd = ffmpeg_command(path, dst, action, media, streams, self.threads)
+
+        started = time.monotonic()
+        try:
+            if action == REMUX:
+                cpu = run_ffmpeg(cmd)
+            else:
+                cpu = self._transcode(cmd)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+
+        os.remove(path)
+        self._record(action, cpu)
+        self.logger.info(
+            f"{action} {streams['video'] or '-'}/{streams['audio'] or '-'} -> {ext} "
+            f"in {time.monotonic() - started:.1f}s ({cpu:.1f}s CPU)"
+        )
+        return {'file_path': dst, 'action': action, 'cpu_seconds': cpu}
+
+    def _transcode(self, cmd) -> float:
+        with self._lock:
+            self._waiting += 1
+        try:
+            return self._transcode_pool.submit(run_ffmpeg, cmd, self.nice).result()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def fit(self, path: str, media: str, fit: Dict[str, Any], max_bytes: int) -> Dict[str, Any]:
+        """
+        Apply a fit plan from format_selection so the result can be sent under `max_bytes`.
+
+        'bitrate' plans re-encode to the planned bitrate; whatever is still too
+        large (including 'split' plans) is cut into sequential parts. Returns
+        {'file_paths', 'action', 'cpu_seconds'}.
+        """
+        cpu = 0.0
+        action = 'split'
+        if fit['mode'] == 'bitrate':
+            base, _ = os.path.splitext(path)
+            dst = f"{base}.fit.{'m4a' if media == 'audio' else 'mp4'}"
+            try:
+                cpu += self._transcode(fit_command(path, dst, media, fit, self.threads))
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                if os.path.exists(dst):
+                    os.remove(dst)
+                raise
+            os.remove(path)
+            path, action = dst, 'bitrate'
+            with self._lock:
+                self.fitted += 1
+                self.cpu_seconds[TRANSCODE] += cpu
+        else:
+            processed = self.process(path, media)
+            path, cpu = processed['file_path'], processed['cpu_seconds']
+
+        if os.path.getsize(path) <= max_bytes:
+            return {'file_paths': [path], 'action': action, 'cpu_seconds': cpu}
+        parts, split_cpu = self._split(path, max_bytes)
+        return {'file_paths': parts, 'action': 'split', 'cpu_seconds': cpu + split_cpu}
+
+    def _split(self, path: str, max_bytes: int):
+        size = os.path.getsize(path)
+        duration = probe_streams(path)['duration']
+        if not duration:
+            raise RuntimeError('Cannot split a file of unknown duration')
+        base, ext = os.path.splitext(path)
+        pattern = f'{base}.part%03d{ext}'
+        segment_seconds = duration * max_bytes * FIT_HEADROOM / size
+        cpu = 0.0
+        for _ in range(SPLIT_ATTEMPTS):
+            cpu += run_ffmpeg(split_command(path, pattern, segment_seconds))
+            directory = os.path.dirname(path)
+            prefix = os.path.basename(base) + '.part'
+            parts = sorted(
+                os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix)
+            )
+            if all(os.path.getsize(part) <= max_bytes for part in parts):
+                os.remove(path)
+                with self._lock:
+                    self.split += 1
+                    self.cpu_seconds[REMUX] += cpu
+                return parts, cpu
+            for part in parts:
+                os.remove(part)
+            segment_seconds *= 0.7
+        raise RuntimeError('Could not split the file into parts under the size limit')
+
+    def _record(self, action: str, cpu: float) -> None:
+        with self._lock:
+            self.counts[action] += 1
+            if action in self.cpu_seconds:
+                self.cpu_seconds[action] += cpu
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'available': self.available,
+                'kept': self.counts[KEEP],
+                'remuxed': self.counts[REMUX],
+                'transcoded': self.counts[TRANSCODE],
+                'fitted_by_bitrate': self.fitted,
+                'split': self.split,
+                'failures': self.failures,
+                'transcodes_waiting': self._waiting,
+                'remux_cpu_seconds': self.cpu_seconds[REMUX],
+                'transcode_cpu_seconds': self.cpu_seconds[TRANSCODE],
+            }
+
+    def shutdown(self) -> None:
+        self._transcode_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,228 @@
+import bisect
+import threading
+from typing import Dict, Any, Optional, Sequence
+
+# Upper bounds in seconds, from fast handler work to long downloads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram (cumulative buckets, like Prometheus).
+
+    Cheap to observe from any thread; quantiles are estimated from the
+    buckets, so they are only as precise as the bucket bounds.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th observation (inf past the last bucket)."""
+        with self._lock:
+            if not self._count:
+                return None
+            rank = q * self._count
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return float('inf')
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            cumulative, seen = {}, 0
+            for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+                seen += count
+                cumulative['+Inf' if bound == float('inf') else str(bound)] = seen
+            total, count = self._sum, self._count
+        return {
+            'count': count,
+            'sum': total,
+            'avg': total / count if count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels."""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(dict(zip(self.labels, key)))} {_format_value(value)}'
+
+
+class HistogramVec:
+    """A Histogram per combination of label values."""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self._children: Dict[tuple, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def child(self, **labels) -> Histogram:
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            histogram = self._children.get(key)
+            if histogram is None:
+                histogram = self._children[key] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, value: float, **labels) -> None:
+        self.child(**labels).observe(value)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            children = list(self._children.items())
+        for key, histogram in children:
+            yield from _render_histogram(self.name, dict(zip(self.labels, key)), histogram)
+
+
+def _render_histogram(name: str, labels: Dict[str, Any], histogram: Histogram):
+    snapshot = histogram.snapshot()
+    for bound, count in snapshot['buckets'].items():
+        yield f'{name}_bucket{_format_labels(dict(labels, le=bound))} {count}'
+    yield f'{name}_sum{_format_labels(labels)} {_format_value(snapshot["sum"])}'
+    yield f'{name}_count{_format_labels(labels)} {snapshot["count"]}'
+
+
+class _Registered:
+    """An existing Histogram, or a callback read at scrape time, exposed under a name."""
+
+    def __init__(self, name: str, help: str, kind: str, source):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.source = source
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        if isinstance(self.source, Histogram):
+            yield from _render_histogram(self.name, {}, self.source)
+            return
+        # Callbacks return a number, or a list of (labels, value) pairs
+        samples = self.source()
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            if value is not None:
+                yield f'{self.name}{_format_labels(labels)} {_format_value(value)}'
+
+
+def _signature(metric):
+    if isinstance(metric, _Registered):
+        return (_Registered, metric.kind)
+    return (type(metric), metric.labels)
+
+
+class Registry:
+    """
+    Collection of metrics rendered in the Prometheus text exposition format.
+
+    Counters and histograms are updated where things happen; gauges and
+    totals that components already keep (queue depths, cache stats) are
+    read through callbacks when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        # A module imported twice gets the metric it registered the first time;
+        # two different metrics under one name are a bug
+        with self._lock:
+            for existing in self._metrics:
+                if existing.name != metric.name:
+                    continue
+                if _signature(existing) != _signature(metric):
+                    raise ValueError(f"Metric {metric.name} is already registered with a different type or labels")
+                return existing
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> HistogramVec:
+        return self._add(HistogramVec(name, help, labels, buckets))
+
+    def register_histogram(self, name: str, help: str, histogram: Histogram) -> None:
+        self._add(_Registered(name, help, 'histogram', histogram))
+
+    def callback(self, name: str, help: str, func, kind: str = 'gauge') -> None:
+        self._add(_Registered(name, help, kind, func))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # One broken callback shouldn't take the whole scrape down
+                lines.append(f'# {metric.name} unavailable: {_escape(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Shared by every component that times a step of handling a request
+STAGE_SECONDS = REGISTRY.histogram(
+    'vidxpress_stage_seconds', 'Time spent in each stage of handling a download request', labels=('stage',)
+)
@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+from file_cache import canonicalize_url
+from scheduler import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self, task: asyncio.Task, user_id: int):
+        self.task = task
+        self.user_id = user_id
+        self.created_at = time.monotonic()
+        self.claimed = False
+
+
+class Prefetcher:
+    """
+    Speculative work started as soon as a link arrives, before the user picks a format.
+
+    Every link gets a low-priority probe through the scheduler, so extractor
+    resolution is usually finished by the time the user taps a button. With
+    `speculative_download` enabled, the format users pick most often is also
+    downloaded in the background and handed over if that format is chosen.
+    Work nobody claims within `ttl` seconds is discarded and counted as waste.
+    """
+
+    def __init__(self, scheduler, download_manager, file_cache=None, speculative_download: bool = False,
+                 ttl: float = 300):
+        self.scheduler = scheduler
+        self.download_manager = download_manager
+        self.file_cache = file_cache
+        self.speculative_download = speculative_download
+        self.ttl = ttl
+        self.logger = logging.getLogger('Prefetcher')
+
+        self._probes: Dict[str, _Entry] = {}
+        self._downloads: Dict[tuple, _Entry] = {}
+        self._choices = {'audio': 0, 'video': 0}
+
+        self.probes_started = 0
+        self.probe_hits = 0
+        self.probe_misses = 0
+        self.probes_cancelled = 0
+        self.probes_unused = 0
+        self.downloads_started = 0
+        self.download_hits = 0
+        self.downloads_wasted = 0
+        self.wasted_bytes = 0
+
+    # --- Starting work ---
+
+    def prefetch(self, user_id: int, url: str) -> asyncio.Task:
+        """Start (or join) background resolution of `url`. The task resolves to the probe or None."""
+        self._sweep()
+        key = canonicalize_url(url)
+        entry = self._probes.get(key)
+        if entry is None or entry.claimed:
+            # A claimed entry belongs to an earlier prompt; the probe itself is cached
+            entry = _Entry(asyncio.create_task(self._run(user_id, url, key)), user_id)
+            self._probes[key] = entry
+            self.probes_started += 1
+        return entry.task
+
+    async def _run(self, user_id: int, url: str, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            probe = await self.scheduler.submit(
+                user_id, ('prefetch', key), self.download_manager.probe, url, background=True
+            )
+        except JobCancelled:
+            return None
+
+        if self.speculative_download and probe['success']:
+            media_format = self.likely_format()
+            already_uploaded = self.file_cache and await self.file_cache.contains(url, media_format)
+            if probe[f'{media_format}_format'] and not already_uploaded:
+                task = asyncio.create_task(self.scheduler.submit(
+                    user_id, ('prefetch-download', key, media_format),
+                    self.download_manager.download, url, audio_only=media_format == 'audio',
+                    needs_transcode=probe[f'{media_format}_transcode'], background=True
+                ))
+                self._downloads[(key, media_format)] = _Entry(task, user_id)
+                self.downloads_started += 1
+        return probe
+
+    def likely_format(self) -> str:
+        return 'audio' if self._choices['audio'] > self._choices['video'] else 'video'
+
+    # --- Claiming work when the user picks a format ---
+
+    def is_claimed(self, url: str) -> bool:
+        entry = self._probes.get(canonicalize_url(url))
+        return entry is not None and entry.claimed
+
+    async def claim_probe(self, url: str) -> None:
+        """
+        Reuse the prefetch for `url` if it is running or done.
+
+        If it is still waiting for a background slot it is cancelled instead,
+        and the download resolves the link itself at normal priority.
+        """
+        key = canonicalize_url(url)
+        entry = self._probes.get(key)
+        if entry is None:
+            self.probe_misses += 1
+            return
+        entry.claimed = True
+        if not entry.task.done() and self.scheduler.cancel(entry.user_id, ('prefetch', key)):
+            self.probes_cancelled += 1
+            return
+        try:
+            await entry.task
+            self.probe_hits += 1
+        except Exception as e:
+            self.probe_misses += 1
+            self.logger.debug(f"Prefetch failed: {e}")
+
+    async def claim_download(self, url: str, media_format: str) -> Optional[Dict[str, Any]]:
+        """Hand over a speculative download of `url` in `media_format`, if one exists and succeeded."""
+        self._choices[media_format] = self._choices.get(media_format, 0) + 1
+        entry = self._downloads.pop((canonicalize_url(url), media_format), None)
+        if entry is None:
+            return None
+        try:
+            result = await entry.task
+        except Exception:
+            return None
+        if not result['success']:
+            self._discard(result)
+            return None
+        self.download_hits += 1
+        return result
+
+    # --- Expiry ---
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        for key, entry in list(self._probes.items()):
+            if entry.task.done() and now - entry.created_at > self.ttl:
+                del self._probes[key]
+                if not entry.claimed:
+                    self.probes_unused += 1
+        for key, entry in list(self._downloads.items()):
+            if entry.task.done() and now - entry.created_at > self.ttl:
+                del self._downloads[key]
+                self.downloads_wasted += 1
+                if not entry.task.cancelled() and not entry.task.exception():
+                    self._discard(entry.task.result())
+
+    def _discard(self, result: Dict[str, Any]) -> None:
+        file_path = result.get('file_path')
+        if file_path and os.path.exists(file_path):
+            self.wasted_bytes += os.path.getsize(file_path)
+        self.download_manager.storage.release(result.get('temp_dir'))
+
+    async def stop(self) -> None:
+        for entry in list(self._probes.values()) + list(self._downloads.values()):
+            entry.task.cancel()
+        for entry in self._downloads.values():
+            try:
+                result = await entry.task
+            except BaseException:
+                continue
+            self._discard(result)
+        self._probes.clear()
+        self._downloads.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        claimed = self.probe_hits + self.probe_misses + self.probes_cancelled
+        return {
+            'probes_started': self.probes_started,
+            'probe_hits': self.probe_hits,
+            'probe_misses': self.probe_misses,
+            'probe_hit_rate': self.probe_hits / claimed if claimed else 0.0,
+            'probes_cancelled': self.probes_cancelled,
+            'probes_unused': self.probes_unused,
+            'downloads_started': self.downloads_started,
+            'download_hits': self.download_hits,
+            'downloads_wasted': self.downloads_wasted,
+            'wasted_bytes': self.wasted_bytes,
+        }
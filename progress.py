@@ -0,0 +1,138 @@
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, Any, Optional
+
+from telegram.error import RetryAfter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_EDITS = REGISTRY.counter(
+    'vidxpress_progress_edits_total', 'Progress message edits by outcome', labels=('outcome',)
+)
+
+STAGE_LABELS = {
+    'resolving': "🔎 Resolving link...",
+    'downloading': "⬇️ Downloading...",
+    'converting': "🛠 Converting...",
+    'uploading': "📤 Uploading to Telegram...",
+}
+BAR_WIDTH = 10
+
+
+def _megabytes(nbytes: float) -> str:
+    return f"{nbytes / 1024 / 1024:.1f}MB"
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def render_progress(event: Dict[str, Any]) -> str:
+    """Status message text for a progress report from DownloadManager (or the upload step)."""
+    stage = event.get('stage')
+    label = STAGE_LABELS.get(stage, "⏳ Processing your request...")
+    if stage == 'uploading' and event.get('parts', 1) > 1:
+        return f"{label}\n\nPart {event['part']}/{event['parts']}"
+    if stage != 'downloading':
+        return label
+
+    downloaded = event.get('downloaded_bytes') or 0
+    total = event.get('total_bytes')
+    details = []
+    if total:
+        fraction = min(1.0, downloaded / total)
+        filled = int(fraction * BAR_WIDTH)
+        details.append(f"{'▓' * filled}{'░' * (BAR_WIDTH - filled)} {fraction * 100:.0f}%")
+        details.append(f"{_megabytes(downloaded)} / {_megabytes(total)}")
+    else:
+        details.append(_megabytes(downloaded))
+    if event.get('speed'):
+        details.append(f"{_megabytes(event['speed'])}/s")
+    if event.get('eta') is not None:
+        details.append(f"ETA {_duration(event['eta'])}")
+    return f"{label}\n\n" + " • ".join(details)
+
+
+class ProgressReporter:
+    """
+    Shows a job's progress by editing its status message.
+
+    `report` may be called from any thread (download workers report from the
+    scheduler's threads). Edits are throttled to one per `interval` seconds to
+    stay within Telegram's edit rate limits, and coalesced: at most one edit is
+    in flight, and reports arriving meanwhile only replace the one sent next.
+    """
+
+    def __init__(self, message, loop: asyncio.AbstractEventLoop, interval: float = 3.0):
+        self.message = message
+        self.loop = loop
+        self.interval = interval
+        self._latest: Optional[Dict[str, Any]] = None
+        self._shown: Optional[str] = None
+        self._next_edit_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._closed = False
+
+    def report(self, event: Dict[str, Any]) -> None:
+        if not self._closed:
+            self.loop.call_soon_threadsafe(self._update, event)
+
+    def _update(self, event: Dict[str, Any]) -> None:
+        if self._closed:
+            return
+        if self._latest is not None:
+            PROGRESS_EDITS.inc(outcome='coalesced')
+        self._latest = event
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._closed or self._latest is None or self._task is not None or self._timer is not None:
+            return
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            self._timer = self.loop.call_later(delay, self._on_timer)
+            return
+        event, self._latest = self._latest, None
+        text = render_progress(event)
+        if text == self._shown:
+            return
+        self._next_edit_at = time.monotonic() + self.interval
+        self._task = self.loop.create_task(self._edit(text))
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._schedule()
+
+    async def _edit(self, text: str) -> None:
+        try:
+            await self.message.edit_text(text)
+            self._shown = text
+            PROGRESS_EDITS.inc(outcome='sent')
+        except RetryAfter as e:
+            # Back off for as long as Telegram asks
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self._next_edit_at = time.monotonic() + max(self.interval, retry_after)
+            PROGRESS_EDITS.inc(outcome='rate_limited')
+        except Exception as e:
+            logger.debug(f"Progress update failed: {e}")
+            PROGRESS_EDITS.inc(outcome='failed')
+        finally:
+            self._task = None
+            self._schedule()
+
+    async def close(self) -> None:
+        """Stop editing, waiting out an edit in flight so it can't land after the final message."""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
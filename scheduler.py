@@ -0,0 +1,295 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Any, Callable, Awaitable, Optional, Hashable
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class JobCancelled(Exception):
+    """Raised to the submitter when a queued job is superseded or cancelled."""
+
+
+class RetryLater(Exception):
+    """
+    Raised by a job to give up its slot and run again after `delay` seconds.
+
+    `kwargs` replace the job's keyword arguments for the next run (e.g. the
+    attempt number). The submitter keeps waiting meanwhile.
+    """
+
+    def __init__(self, delay: float, **kwargs):
+        super().__init__(f"Retry in {delay:.1f}s")
+        self.delay = delay
+        self.kwargs = kwargs
+
+
+class Job:
+    def __init__(self, user_id: int, key: Hashable, func: Callable, args: tuple, kwargs: dict,
+                 needs_transcode: bool, on_position: Optional[PositionCallback], background: bool = False,
+                 user_limit: Optional[int] = None):
+        self.user_id = user_id
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.needs_transcode = needs_transcode
+        self.on_position = on_position
+        self.background = background
+        self.user_limit = user_limit
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.position = None
+
+
+class DownloadScheduler:
+    """
+    Fair, bounded job queue in front of the blocking DownloadManager.
+
+    At most `max_downloads` jobs run at once (and at most `max_transcodes` of
+    those may need ffmpeg), each user may have `per_user_limit` jobs running,
+    and waiting users are served round-robin so one heavy user cannot starve
+    the others. Blocking work runs on a dedicated thread pool instead of the
+    event loop's default executor.
+
+    Background (speculative) jobs wait in a separate FIFO queue. They only
+    start when no user-requested job is eligible, never occupy more than
+    `max_background` slots and don't count against the per-user cap.
+    """
+
+    def __init__(self, max_downloads: int = 2, max_transcodes: int = 1, per_user_limit: int = 1,
+                 max_background: Optional[int] = None):
+        self.max_downloads = max_downloads
+        self.max_transcodes = max_transcodes
+        self.per_user_limit = per_user_limit
+        # Keep at least one slot free for user-requested work
+        self.max_background = max_background if max_background is not None else max(1, max_downloads - 1)
+        self.logger = logging.getLogger('DownloadScheduler')
+
+        self._executor = ThreadPoolExecutor(max_workers=max_downloads, thread_name_prefix='download')
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()
+        self._background_queue: deque = deque()
+        self._running_per_user: Dict[int, int] = {}
+        self._running = 0
+        self._running_background = 0
+        self._transcoding = 0
+        self._callback_tasks = set()
+        # Jobs backing off before a retry, with the timer that requeues them
+        self._retrying: Dict[Job, asyncio.TimerHandle] = {}
+
+        self.completed = 0
+        self.cancelled = 0
+        self.retried = 0
+        self._wait_times = deque(maxlen=500)
+
+    async def submit(self, user_id: int, key: Hashable, func: Callable, *args,
+                     needs_transcode: bool = False, on_position: Optional[PositionCallback] = None,
+                     background: bool = False, user_limit: Optional[int] = None, **kwargs) -> Any:
+        """
+        Queue `func(*args, **kwargs)` for `user_id` and wait for its result.
+
+        Submitting the same `key` again for a user cancels the older job if it is
+        still waiting (the user re-sent the request). Raises JobCancelled when
+        this job is superseded in turn. `background` marks low-priority work.
+        `user_limit` overrides the per-user cap for this job (batch items run in parallel).
+        """
+        self.cancel(user_id, key)
+
+        job = Job(user_id, key, func, args, kwargs, needs_transcode, on_position, background, user_limit)
+        if background:
+            self._background_queue.append(job)
+        else:
+            self._queues.setdefault(user_id, deque()).append(job)
+        self._dispatch()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # The awaiting handler went away; don't run work nobody will collect
+            self._remove(job)
+            raise
+
+    def cancel(self, user_id: int, key: Optional[Hashable] = None) -> int:
+        """Cancel a user's waiting jobs (all of them, or only the one with `key`)."""
+        queued = list(self._queues.get(user_id, ())) + [
+            job for job in [*self._background_queue, *self._retrying] if job.user_id == user_id
+        ]
+        victims = [job for job in queued if key is None or job.key == key]
+        for job in victims:
+            self._remove(job)
+            if not job.future.done():
+                job.future.set_exception(JobCancelled())
+        self.cancelled += len(victims)
+        if victims:
+            self._notify_positions()
+        return len(victims)
+
+    def _remove(self, job: Job) -> None:
+        timer = self._retrying.pop(job, None)
+        if timer is not None:
+            timer.cancel()
+            return
+        if job.background:
+            if job in self._background_queue:
+                self._background_queue.remove(job)
+            return
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user_id]
+
+    def _dispatch(self) -> None:
+        """Start as many waiting jobs as the limits allow, round-robin across users."""
+        while self._running < self.max_downloads:
+            job = self._next_eligible()
+            if job is None:
+                break
+            self._start(job)
+        self._notify_positions()
+
+    def _next_eligible(self) -> Optional[Job]:
+        for user_id, queue in list(self._queues.items()):
+            job = queue[0]
+            if self._running_per_user.get(user_id, 0) >= (job.user_limit or self.per_user_limit):
+                continue
+            if job.needs_transcode and self._transcoding >= self.max_transcodes:
+                continue
+            queue.popleft()
+            # Move the user to the back of the line
+            del self._queues[user_id]
+            if queue:
+                self._queues[user_id] = queue
+            return job
+        if self._background_queue and self._running_background < self.max_background:
+            job = self._background_queue[0]
+            if not job.needs_transcode or self._transcoding < self.max_transcodes:
+                return self._background_queue.popleft()
+        return None
+
+    def _start(self, job: Job) -> None:
+        self._running += 1
+        if job.background:
+            self._running_background += 1
+        else:
+            self._running_per_user[job.user_id] = self._running_per_user.get(job.user_id, 0) + 1
+        if job.needs_transcode:
+            self._transcoding += 1
+        if not job.background:
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_times.append(wait)
+            STAGE_SECONDS.observe(wait, stage='queue_wait')
+        self._set_position(job, 0)
+
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(self._executor, partial(job.func, *job.args, **job.kwargs))
+        task.add_done_callback(lambda fut: self._finish(job, fut))
+
+    def _finish(self, job: Job, fut: asyncio.Future) -> None:
+        self._running -= 1
+        if job.background:
+            self._running_background -= 1
+        else:
+            remaining = self._running_per_user.get(job.user_id, 1) - 1
+            if remaining:
+                self._running_per_user[job.user_id] = remaining
+            else:
+                self._running_per_user.pop(job.user_id, None)
+        if job.needs_transcode:
+            self._transcoding -= 1
+        self.completed += 1
+
+        if isinstance(fut.exception(), RetryLater) and not job.future.done():
+            # Back off without holding a slot, then rejoin the front of the line
+            retry = fut.exception()
+            job.kwargs.update(retry.kwargs)
+            self.retried += 1
+            self._retrying[job] = asyncio.get_running_loop().call_later(retry.delay, self._requeue, job)
+        elif not job.future.done():
+            if fut.exception():
+                job.future.set_exception(fut.exception())
+            else:
+                job.future.set_result(fut.result())
+        self._dispatch()
+
+    def _requeue(self, job: Job) -> None:
+        del self._retrying[job]
+        if job.future.done():
+            return
+        job.enqueued_at = time.monotonic()
+        if job.background:
+            self._background_queue.appendleft(job)
+        else:
+            queue = self._queues.get(job.user_id)
+            if queue is None:
+                queue = self._queues[job.user_id] = deque()
+            queue.appendleft(job)
+        self._dispatch()
+
+    def _projected_order(self):
+        """Waiting jobs in the order round-robin dispatch would start them."""
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+        depth = 0
+        while any(depth < len(queue) for queue in queues):
+            order.extend(queue[depth] for queue in queues if depth < len(queue))
+            depth += 1
+        return order
+
+    def _notify_positions(self) -> None:
+        for index, job in enumerate(self._projected_order(), start=1):
+            self._set_position(job, index)
+
+    def _set_position(self, job: Job, position: int) -> None:
+        if job.position == position:
+            return
+        job.position = position
+        if job.on_position:
+            task = asyncio.get_running_loop().create_task(self._call_position(job, position))
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+
+    async def _call_position(self, job: Job, position: int) -> None:
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            self.logger.debug(f"Queue position update failed: {e}")
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._wait_times)
+        return {
+            'queue_depth': self.queue_depth,
+            'background_queue_depth': len(self._background_queue),
+            'running': self._running,
+            'running_background': self._running_background,
+            'transcoding': self._transcoding,
+            'retrying': len(self._retrying),
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'retried': self.retried,
+            'wait_seconds_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_seconds_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        for timer in self._retrying.values():
+            timer.cancel()
+        for queue in list(self._queues.values()) + [self._background_queue, list(self._retrying)]:
+            for job in queue:
+                if not job.future.done():
+                    job.future.set_exception(JobCancelled())
+        self._queues.clear()
+        self._background_queue.clear()
+        self._retrying.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Dict, Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one execution.
+
+    The first caller for a key (the leader) runs the work; callers arriving
+    while it is in flight wait for the same result instead of repeating it.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._owners: Dict[Hashable, Hashable] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]],
+                 owner: Optional[Hashable] = None) -> Tuple[Any, bool]:
+        """
+        Run `func()` for `key`, or wait for the run already in progress.
+
+        Returns (result, shared) where `shared` is True for callers that
+        received another caller's result. `owner` (e.g. the user) is
+        remembered for the leader; see `owner_of`.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # Shield so a follower going away doesn't cancel the leader's work
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self._owners[key] = owner
+        self.leaders += 1
+        try:
+            result = await func()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unobserved failure isn't logged as never-awaited
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+            del self._owners[key]
+
+    def owner_of(self, key: Hashable) -> Optional[Hashable]:
+        """The owner of the run in flight for `key`, if any."""
+        return self._owners.get(key)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': self.in_flight,
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,329 @@
+import time
+import queue
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Any, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """
+    Minimal key/value store shared by all workers that serve the webhook.
+
+    Values are strings; callers serialize anything richer. `ttl` is in seconds.
+    """
+
+    name = 'base'
+    # True when other processes (uvicorn workers, replicas) see the same data
+    shared = False
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Atomically store `value` only if `key` is unset. Returns True if it was stored."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Process-local store; the default for a single worker."""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._live(key)
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            self._maybe_purge()
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            self._maybe_purge()
+            return True
+
+    def _maybe_purge(self) -> None:
+        # Keys that are never read again would otherwise stay forever
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            now = time.time()
+            for key in [k for k, (_, expires_at) in self._data.items() if expires_at is not None and expires_at < now]:
+                del self._data[key]
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._lock:
+            entry = self._data.get(key)
+            value = int(entry[0]) + amount if entry else amount
+            self._data[key] = (str(value), entry[1] if entry else None)
+            return value
+
+
+class SQLiteBackend(StateBackend):
+    """Store in a SQLite file (WAL), shared by every worker on the same host."""
+
+    name = 'sqlite'
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+        self._conn.commit()
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, time.time() + ttl if ttl else None)
+            )
+            self._maybe_purge()
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM kv WHERE key = ? AND expires_at <= ?', (key, now))
+            stored = self._conn.execute(
+                'INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, now + ttl if ttl else None)
+            ).rowcount
+            self._maybe_purge()
+        return stored == 1
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO kv (key, value, expires_at) VALUES (?, ?, NULL) '
+                'ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + ?',
+                (key, str(amount), amount)
+            )
+            return int(self._conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()[0])
+
+    def _maybe_purge(self) -> None:
+        # Expired rows are skipped on read; sweep them out every so often
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._conn.execute('DELETE FROM kv WHERE expires_at <= ?', (time.time(),))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisBackend(StateBackend):
+    """
+    Store in any server speaking the Redis protocol (RESP2).
+
+    Uses a small built-in client with a pool of blocking connections, so no
+    extra dependency is required; Redis, Valkey, KeyDB or a local stand-in
+    all work.
+    """
+
+    name = 'redis'
+    shared = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, pool_size: int = 8, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue" = queue.LifoQueue(maxsize=pool_size)
+
+    # --- Connection handling ---
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile('rb'))
+        if self.password:
+            self._roundtrip(conn, [('AUTH', self.password)])
+        if self.db:
+            self._roundtrip(conn, [('SELECT', self.db)])
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn[0].close()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            return RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = reader.read(length + 2)[:-2]
+            return data.decode()
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def _roundtrip(self, conn, commands) -> List[Any]:
+        sock, reader = conn
+        sock.sendall(b''.join(self._encode(command) for command in commands))
+        replies = [self._read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands) -> List[Any]:
+        """Send several commands in one round trip and return their replies."""
+        conn = self._acquire()
+        try:
+            replies = self._roundtrip(conn, commands)
+        except RedisError:
+            self._release(conn)
+            raise
+        except (OSError, ConnectionError):
+            # Drop the broken connection; the caller may retry on a fresh one
+            conn[0].close()
+            raise
+        self._release(conn)
+        return replies
+
+    def execute(self, *args) -> Any:
+        return self.pipeline([args])[0]
+
+    # --- StateBackend API ---
+
+    def get(self, key: str) -> Optional[str]:
+        return self.execute('GET', key)
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        if ttl:
+            self.execute('SET', key, value, 'PX', int(ttl * 1000))
+        else:
+            self.execute('SET', key, value)
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        if ttl:
+            return self.execute('SET', key, value, 'NX', 'PX', int(ttl * 1000)) == 'OK'
+        return self.execute('SET', key, value, 'NX') == 'OK'
+
+    def delete(self, key: str) -> None:
+        self.execute('DEL', key)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        return self.execute('INCRBY', key, amount)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait()[0].close()
+            except queue.Empty:
+                break
+
+
+def create_backend(url: str = 'memory://') -> StateBackend:
+    """
+    Build a backend from a URL:
+
+        memory://                       process-local (single worker)
+        sqlite:///state.db              shared by workers on one host
+        redis://[:password@]host:port/db  shared across hosts
+    """
+    parts = urlsplit(url)
+    if parts.scheme in ('', 'memory'):
+        return MemoryBackend()
+    if parts.scheme == 'sqlite':
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        return SQLiteBackend(parts.path[1:])
+    if parts.scheme == 'redis':
+        return RedisBackend(
+            host=parts.hostname or '127.0.0.1',
+            port=parts.port or 6379,
+            db=int(parts.path.lstrip('/') or 0),
+            password=parts.password
+        )
+    raise ValueError(f"Unsupported state backend: {url}")
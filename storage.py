@@ -0,0 +1,240 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from download_engines import directory_size
+
+logger = logging.getLogger(__name__)
+
+JOB_PREFIX = 'job-'
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _last_modified(path: str) -> float:
+    """Newest mtime of a directory and everything in it (a growing .part file doesn't touch the directory)."""
+    latest = os.stat(path).st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest, os.stat(os.path.join(dirpath, name)).st_mtime)
+            except OSError:
+                pass
+    return latest
+
+
+class _Reservation:
+    def __init__(self, path: str, nbytes: int, in_memory: bool):
+        self.path = path
+        self.nbytes = nbytes
+        self.in_memory = in_memory
+
+
+class StorageManager:
+    """
+    Owns the work directories downloads are written to.
+
+    Every job gets a directory under one work root, named after the owning
+    process, and is only admitted once its estimated size fits in the disk
+    budget. Directories left behind by crashed workers or missed cleanups are
+    reaped at startup and periodically. Small audio jobs can be placed on a
+    tmpfs (e.g. /dev/shm) with its own, smaller budget.
+    """
+
+    def __init__(self, root: str, budget_bytes: int, tmpfs_root: Optional[str] = None,
+                 tmpfs_budget_bytes: int = 256 * 1024 * 1024, tmpfs_max_job_bytes: int = 32 * 1024 * 1024,
+                 orphan_age: float = 3600, min_free_bytes: int = 512 * 1024 * 1024):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.tmpfs_root = tmpfs_root if tmpfs_root and os.path.isdir(tmpfs_root) else None
+        self.tmpfs_budget_bytes = tmpfs_budget_bytes
+        self.tmpfs_max_job_bytes = tmpfs_max_job_bytes
+        self.orphan_age = orphan_age
+        self.min_free_bytes = min_free_bytes
+        self.logger = logging.getLogger('StorageManager')
+
+        self._roots = [root]
+        if self.tmpfs_root:
+            self.tmpfs_root = os.path.join(self.tmpfs_root, 'vidxpress-work')
+            self._roots.append(self.tmpfs_root)
+        for path in self._roots:
+            os.makedirs(path, exist_ok=True)
+
+        self._jobs: Dict[str, _Reservation] = {}
+        self._reserved = 0
+        self._reserved_memory = 0
+        self._cond = threading.Condition()
+        self._task = None
+
+        self.admitted = 0
+        self.admitted_memory = 0
+        self.waited = 0
+        self.rejected = 0
+        self.reaped = 0
+        self.reaped_bytes = 0
+
+        self.reap_orphans()
+
+    # --- Admission ---
+
+    def acquire(self, nbytes: int, prefer_memory: bool = False, timeout: float = 60) -> Optional[str]:
+        """
+        Reserve `nbytes` and create a job directory for them.
+
+        Blocks until the budget allows it, for up to `timeout` seconds.
+        Returns the directory, or None if no space became available.
+        """
+        nbytes = min(nbytes, self.budget_bytes)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if prefer_memory and self.tmpfs_root and nbytes <= self.tmpfs_max_job_bytes \
+                    and self._reserved_memory + nbytes <= self.tmpfs_budget_bytes:
+                self._reserved_memory += nbytes
+                self.admitted_memory += 1
+                return self._create(self.tmpfs_root, nbytes, in_memory=True)
+
+            waited = False
+            while not self._fits(nbytes):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    self.logger.warning(f"No room for a {nbytes / 1024 / 1024:.1f}MB job "
+                                        f"({self._reserved / 1024 / 1024:.1f}MB reserved)")
+                    return None
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self.waited += 1
+            self._reserved += nbytes
+            self.admitted += 1
+            return self._create(self.root, nbytes, in_memory=False)
+
+    def _fits(self, nbytes: int) -> bool:
+        if self._reserved + nbytes > self.budget_bytes:
+            return False
+        # The budget may be larger than what is actually left on the volume
+        free = shutil.disk_usage(self.root).free
+        return free - nbytes >= self.min_free_bytes or not self._reserved
+
+    def _create(self, parent: str, nbytes: int, in_memory: bool) -> str:
+        """Caller must hold `_cond`."""
+        path = os.path.join(parent, f'{JOB_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:12]}')
+        self._jobs[path] = _Reservation(path, nbytes, in_memory)
+        os.makedirs(path)
+        return path
+
+    def release(self, path: Optional[str]) -> None:
+        """Delete a job directory and return its reservation to the budget."""
+        if not path:
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        with self._cond:
+            job = self._jobs.pop(path, None)
+            if job is None:
+                return
+            if job.in_memory:
+                self._reserved_memory -= job.nbytes
+            else:
+                self._reserved -= job.nbytes
+            self._cond.notify_all()
+
+    # --- Orphan reaping ---
+
+    def reap_orphans(self) -> int:
+        """
+        Remove job directories nobody owns any more.
+
+        That is directories of processes that no longer exist, directories of
+        this process that are not registered (a missed cleanup), and, for
+        another live process, directories where nothing has been written for
+        `orphan_age` (a slow download keeps touching its files).
+        """
+        reaped = 0
+        now = time.time()
+        for root in self._roots:
+            try:
+                entries = list(os.scandir(root))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.startswith(JOB_PREFIX) or not entry.is_dir():
+                    continue
+                try:
+                    pid = int(entry.name[len(JOB_PREFIX):].split('-')[0])
+                except ValueError:
+                    continue
+                with self._cond:
+                    active = entry.path in self._jobs
+                if active:
+                    continue
+                orphaned = pid == os.getpid() or not _pid_alive(pid)
+                if not orphaned:
+                    try:
+                        orphaned = now - _last_modified(entry.path) > self.orphan_age
+                    except OSError:
+                        continue
+                if orphaned:
+                    size = directory_size(entry.path)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    reaped += 1
+                    self.reaped_bytes += size
+        if reaped:
+            self.reaped += reaped
+            self.logger.info(f"Reaped {reaped} orphaned job directories")
+        return reaped
+
+    async def start(self, interval: float = 600) -> None:
+        self._task = asyncio.create_task(self._run(interval))
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reap_orphans)
+            except Exception as e:
+                self.logger.error(f"Orphan reaping failed: {e}")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Metrics ---
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            jobs = list(self._jobs.values())
+            reserved, reserved_memory = self._reserved, self._reserved_memory
+        used = sum(directory_size(job.path) for job in jobs if os.path.isdir(job.path))
+        return {
+            'root': self.root,
+            'budget_bytes': self.budget_bytes,
+            'reserved_bytes': reserved,
+            'used_bytes': used,
+            'tmpfs_reserved_bytes': reserved_memory,
+            'active_jobs': len(jobs),
+            'free_bytes': shutil.disk_usage(self.root).free,
+            'admitted': self.admitted,
+            'admitted_tmpfs': self.admitted_memory,
+            'waited': self.waited,
+            'rejected': self.rejected,
+            'reaped': self.reaped,
+            'reaped_bytes': self.reaped_bytes,
+        }
@@ -0,0 +1,35 @@
+import io
+import json
+
+from telegram.request import RequestData
+from telegram.request._requestparameter import RequestParameter
+
+from batch import media_group
+
+
+def encode(items):
+    """The sendMediaGroup body python-telegram-bot would send for `items`."""
+    data = RequestData([RequestParameter.from_input('media', items)])
+    return json.loads(data.json_parameters['media']), data.multipart_data
+
+
+def test_uploaded_files_get_their_own_attach_fields():
+    files = [io.BytesIO(bytes([n]) * 1024) for n in range(4)]
+    media, parts = encode(media_group('video', files, caption='caption'))
+
+    references = [item['media'] for item in media]
+    assert all(reference.startswith('attach://') for reference in references)
+    assert len(set(references)) == len(files)
+    assert set(parts) == {reference[len('attach://'):] for reference in references}
+    assert [parts[reference[len('attach://'):]][1] for reference in references] == files
+    assert [item.get('caption') for item in media] == ['caption', None, None, None]
+
+
+def test_cached_file_ids_are_sent_by_reference():
+    upload = io.BytesIO(b'audio')
+    media, parts = encode(media_group('audio', ['cached-id', upload]))
+
+    assert [item['type'] for item in media] == ['audio', 'audio']
+    assert media[0]['media'] == 'cached-id'
+    assert media[1]['media'].startswith('attach://')
+    assert list(parts) == [media[1]['media'][len('attach://'):]]
@@ -0,0 +1,190 @@
+import os
+import asyncio
+import logging
+import importlib.util
+from typing import Dict, Any, Optional
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'vidxpress_bot_api_requests_total', 'Bot API requests by connection pool and outcome', labels=('pool', 'outcome')
+)
+UPLOAD_BYTES = REGISTRY.counter(
+    'vidxpress_bot_api_upload_bytes_total', 'Bytes of files sent to the Bot API'
+)
+
+
+def payload_size(request_data: Optional[RequestData]) -> int:
+    """Total size of the files in a request, whether held in memory or as open file handles."""
+    if not request_data or not request_data.contains_files:
+        return 0
+    total = 0
+    for _, content, _ in request_data.multipart_data.values():
+        if isinstance(content, bytes):
+            total += len(content)
+        else:
+            try:
+                total += os.fstat(content.fileno()).st_size - content.tell()
+            except (AttributeError, OSError):
+                pass
+    return total
+
+
+def upload_deadline(nbytes: int, base: float, min_rate: float) -> float:
+    """Seconds an upload of `nbytes` may take at no less than `min_rate` bytes/s."""
+    return base + nbytes / min_rate
+
+
+class PooledRequest(HTTPXRequest):
+    """HTTPXRequest that counts what goes through its connection pool."""
+
+    def __init__(self, name: str, connection_pool_size: int, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.name = name
+        self.pool_size = connection_pool_size
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.pool_timeouts = 0
+        self.failures = 0
+
+    async def do_request(self, *args, **kwargs):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        outcome = 'ok'
+        try:
+            return await super().do_request(*args, **kwargs)
+        except TimedOut as e:
+            # httpx.PoolTimeout surfaces as TimedOut("Pool timeout: ...")
+            outcome = 'pool_timeout' if 'Pool timeout' in str(e) else 'timeout'
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            self.in_flight -= 1
+            self.requests += 1
+            if outcome == 'pool_timeout':
+                self.pool_timeouts += 1
+            elif outcome != 'ok':
+                self.failures += 1
+            HTTP_REQUESTS.inc(pool=self.name, outcome=outcome)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'http_version': self.http_version,
+            'pool_size': self.pool_size,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'utilization': self.in_flight / self.pool_size if self.pool_size else 0.0,
+            'requests': self.requests,
+            'pool_timeouts': self.pool_timeouts,
+            'failures': self.failures,
+        }
+
+
+class RoutingRequest(BaseRequest):
+    """
+    Sends file uploads through one connection pool and every other Bot API call through another.
+
+    A few large uploads can hold connections for minutes; on a shared pool they
+    starve the small calls (answers, edits, prompts) that users are waiting on.
+    Uploads also get a deadline that grows with their size instead of one
+    fixed timeout, so big files aren't cut off and stalled small ones are.
+    """
+
+    def __init__(self, api: PooledRequest, media: PooledRequest,
+                 upload_base_timeout: float = 30, upload_min_rate: float = 256 * 1024):
+        self.api = api
+        self.media = media
+        self.upload_base_timeout = upload_base_timeout
+        self.upload_min_rate = upload_min_rate
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.upload_deadline_exceeded = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.api.read_timeout
+
+    async def initialize(self) -> None:
+        await asyncio.gather(self.api.initialize(), self.media.initialize())
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(self.api.shutdown(), self.media.shutdown())
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        if not request_data or not request_data.contains_files:
+            return await self.api.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+
+        nbytes = payload_size(request_data)
+        deadline = upload_deadline(nbytes, self.upload_base_timeout, self.upload_min_rate)
+        if read_timeout is BaseRequest.DEFAULT_NONE:
+            # Telegram answers only once it has processed the file
+            read_timeout = deadline
+        self.uploads += 1
+        self.upload_bytes += nbytes
+        UPLOAD_BYTES.inc(nbytes)
+        try:
+            return await asyncio.wait_for(
+                self.media.do_request(
+                    url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                    connect_timeout=connect_timeout, pool_timeout=pool_timeout
+                ),
+                deadline
+            )
+        except asyncio.TimeoutError as e:
+            self.upload_deadline_exceeded += 1
+            raise TimedOut(f"Upload of {nbytes / 1024 / 1024:.1f}MB did not finish in {deadline:.0f}s") from e
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'api': self.api.stats(),
+            'media': self.media.stats(),
+            'uploads': self.uploads,
+            'upload_bytes': self.upload_bytes,
+            'upload_deadline_exceeded': self.upload_deadline_exceeded,
+        }
+
+
+def create_request(api_pool_size: int = 64, media_pool_size: int = 8, http2: bool = True,
+                   keepalive_expiry: float = 30, upload_base_timeout: float = 30,
+                   upload_min_rate: float = 256 * 1024) -> RoutingRequest:
+    """
+    Build the Bot API transport: an API pool (HTTP/2 when available) and an HTTP/1.1 upload pool.
+
+    HTTP/2 needs the optional `h2` package (`pip install "python-telegram-bot[http2]"`);
+    without it the API pool stays on HTTP/1.1. Uploads always use HTTP/1.1 so
+    each one gets its own connection instead of sharing one stream's window.
+    """
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning("h2 is not installed; Bot API calls use HTTP/1.1")
+        http2 = False
+
+    api = PooledRequest(
+        'api', api_pool_size, http_version='2' if http2 else '1.1',
+        read_timeout=10, write_timeout=10, connect_timeout=5, pool_timeout=3,
+        httpx_kwargs={'limits': httpx.Limits(
+            max_connections=api_pool_size, max_keepalive_connections=api_pool_size, keepalive_expiry=keepalive_expiry
+        )}
+    )
+    media = PooledRequest(
+        'media', media_pool_size, http_version='1.1',
+        read_timeout=30, write_timeout=30, connect_timeout=10, pool_timeout=60, media_write_timeout=30,
+        httpx_kwargs={'limits': httpx.Limits(
+            max_connections=media_pool_size, max_keepalive_connections=media_pool_size,
+            keepalive_expiry=keepalive_expiry
+        )}
+    )
+    return RoutingRequest(api, media, upload_base_timeout=upload_base_timeout, upload_min_rate=upload_min_rate)
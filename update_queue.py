@@ -0,0 +1,135 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Awaitable, Callable, Optional
+
+from metrics import Histogram
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+FULL = 'full'
+
+
+class UpdateQueue:
+    """
+    Bounded queue between the webhook endpoint and the bot's handlers.
+
+    The webhook only validates and enqueues, so Telegram gets its 200 right
+    away; `workers` tasks then process updates concurrently. Updates Telegram
+    re-delivers are dropped by `update_id` (across workers too when a shared
+    `state` backend is given), and a full queue is reported to the caller so
+    it can push back instead of buffering without limit.
+    """
+
+    def __init__(self, process: Callable[[Dict[str, Any]], Awaitable[None]], workers: int = 8,
+                 max_size: int = 1000, dedupe_ttl: float = 3600, state=None):
+        self.process = process
+        self.workers = workers
+        self.max_size = max_size
+        self.dedupe_ttl = dedupe_ttl
+        self.state = state
+        self.logger = logging.getLogger('UpdateQueue')
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._seen = TTLCache(max_entries=max(10000, max_size * 10), default_ttl=dedupe_ttl)
+        self._busy = 0
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.queue_wait = Histogram()
+        self.handling_time = Histogram()
+
+    async def submit(self, payload: Dict[str, Any]) -> str:
+        """Enqueue one update. Returns QUEUED, DUPLICATE or FULL."""
+        update_id = payload['update_id']
+        if self._seen.get(update_id) or not await self._claim(update_id):
+            self.duplicates += 1
+            return DUPLICATE
+
+        if self._queue is None or self._queue.full():
+            # Forget the claim: Telegram will deliver the update again later
+            await self._release(update_id)
+            self.rejected += 1
+            return FULL
+
+        self._seen.set(update_id, True)
+        self._queue.put_nowait((payload, time.monotonic()))
+        self.accepted += 1
+        return QUEUED
+
+    async def _claim(self, update_id: int) -> bool:
+        if self.state is None or not self.state.shared:
+            return True
+        try:
+            return await asyncio.to_thread(
+                self.state.set_if_absent, f"update:{update_id}", '1', self.dedupe_ttl
+            )
+        except Exception as e:
+            # Better to risk a duplicate than to drop the update
+            self.logger.warning(f"Update dedupe unavailable: {e}")
+            return True
+
+    async def _release(self, update_id: int) -> None:
+        if self.state is None or not self.state.shared:
+            return
+        try:
+            await asyncio.to_thread(self.state.delete, f"update:{update_id}")
+        except Exception as e:
+            self.logger.warning(f"Could not release update {update_id}: {e}")
+
+    async def _worker(self) -> None:
+        while True:
+            payload, enqueued_at = await self._queue.get()
+            started = time.monotonic()
+            self.queue_wait.observe(started - enqueued_at)
+            self._busy += 1
+            try:
+                await self.process(payload)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                self.logger.error(f"Update {payload.get('update_id')} failed: {e}")
+            finally:
+                self._busy -= 1
+                self.handling_time.observe(time.monotonic() - started)
+                self._queue.task_done()
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Give queued updates up to `timeout` seconds to finish, then cancel the workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Dropping {self._queue.qsize()} queued updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'max_size': self.max_size,
+            'workers': self.workers,
+            'busy_workers': self._busy,
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'queue_wait_seconds': self.queue_wait.snapshot(),
+            'handling_seconds': self.handling_time.snapshot(),
+        }